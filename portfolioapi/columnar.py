@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Compiled account files.  The transactions of a text file are stored as
+# columns that are memory-mapped when loaded:
+#
+#   header
+#   count, amount1, amount2   float64
+#   date, end, name, name2    int32 (end is the running maximum of the dates)
+#   type, flags               uint8
+#   strings                   UTF-8, separated by newlines
+#
+# The string table starts with the transaction types followed by the interned
+# names.  The flags record which of count, amount1, and amount2 were not given
+# in the text file and hold the integer defaults of Transaction.  The header
+# contains the fingerprint of the text file, which remains the source of truth.
+
+from array import array
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = b'PTXC'
+VERSION = 1
+# magic, version, byte order, fingerprint (mtime_ns, size, inode),
+# number of transactions, number of types, length of the string table
+header = struct.Struct('<4sHHqqqIII')
+byte_order = 1 if sys.byteorder == 'little' else 2
+float_columns = ['count', 'amount1', 'amount2']
+
+
+class CompiledTransactions:
+    # Read-only sequence of transactions.  Transaction objects are only
+    # created when accessed and are kept for later accesses.
+    def __init__(self, buf, count, ntypes, strings, factory):
+        self.count = count
+        self.factory = factory
+        offset = header.size
+        columns = []
+        for typecode, size in [('d', 8)] * 3 + [('i', 4)] * 4 + [('B', 1)] * 2:
+            columns.append(buf[offset:offset + count * size].cast(typecode))
+            offset += count * size
+        (self.counts, self.amounts1, self.amounts2, self.dates, self.ends,
+         self.names, self.names2, self.types, self.flags) = columns
+        self.type_names = strings[:ntypes]
+        self.strings = strings
+        self.transactions = [None] * count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.get(i)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.get(i) for i in range(*key.indices(self.count))]
+        if key < 0:
+            key += self.count
+        if key < 0 or key >= self.count:
+            raise IndexError('transaction index out of range')
+        return self.get(key)
+
+    def get(self, i):
+        t = self.transactions[i]
+        if t is None:
+            t = self.factory(self.dates[i], self.type_names[self.types[i]],
+                             self.strings[self.names[i]])
+            t.name2 = self.strings[self.names2[i]]
+            flags = self.flags[i]
+            t.count = int(self.counts[i]) if flags & 1 else self.counts[i]
+            t.amount1 = int(self.amounts1[i]) if flags & 2 else self.amounts1[i]
+            t.amount2 = int(self.amounts2[i]) if flags & 4 else self.amounts2[i]
+            self.transactions[i] = t
+        return t
+
+
+def load(path, fingerprint, factory):
+    # Returns None if the file is missing, damaged, or out of date.
+    try:
+        with open(path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        view = memoryview(buf)
+        (magic, version, order, mtime, size, ino, count, ntypes,
+         nstrings) = header.unpack_from(view)
+        if (magic != MAGIC or version != VERSION or order != byte_order or
+            (mtime, size, ino) != tuple(fingerprint)):
+            return None
+        offset = header.size + count * (3 * 8 + 4 * 4 + 2)
+        if offset + nstrings != len(view):
+            return None
+        strings = str(view[offset:], 'utf-8').split('\n')
+        return CompiledTransactions(view, count, ntypes, strings, factory)
+    except (struct.error, TypeError, ValueError):
+        return None
+
+
+def write(path, fingerprint, transactions):
+    types = {}
+    for t in transactions:
+        types.setdefault(t.type, len(types))
+    if len(types) > 256:
+        return False
+    strings = dict(types)
+    columns = {k: array('d') for k in float_columns}
+    columns.update((k, array('i')) for k in ['date', 'end', 'name', 'name2'])
+    columns.update((k, array('B')) for k in ['type', 'flags'])
+    end = None
+    for t in transactions:
+        end = t.date if end is None else max(end, t.date)
+        flags = 0
+        for i, k in enumerate(float_columns):
+            v = getattr(t, k)
+            columns[k].append(v)
+            if isinstance(v, int):
+                flags |= 1 << i
+        columns['date'].append(t.date)
+        columns['end'].append(end)
+        columns['name'].append(strings.setdefault(t.name, len(strings)))
+        columns['name2'].append(strings.setdefault(t.name2, len(strings)))
+        columns['type'].append(types[t.type])
+        columns['flags'].append(flags)
+    table = '\n'.join(strings).encode('utf-8')
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    # Write to a temporary file and rename it so that readers never see a
+    # partial file and existing mappings stay valid.
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.compile-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.pack(MAGIC, VERSION, byte_order, *fingerprint,
+                                len(transactions), len(types), len(table)))
+            for k in float_columns + ['date', 'end', 'name', 'name2', 'type',
+                                      'flags']:
+                columns[k].tofile(f)
+            f.write(table)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
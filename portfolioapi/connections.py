@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import os
+import sqlite3
+import threading
+
+# Executed for every new connection.  With WAL, readers don't block the
+# writer and vice versa, which matters with several mod_wsgi threads.
+pragmas = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000'
+]
+# Seconds to wait for a lock held by another connection
+busy_timeout = 30
+# Number of prepared statements kept by each connection
+cached_statements = 256
+
+
+class PooledConnection:
+    __slots__ = ['conn', 'inode', 'done', 'depth']
+
+    def __init__(self, conn, inode):
+        self.conn = conn
+        self.inode = inode
+        # Setup functions that have been executed for the connection
+        self.done = set()
+        self.depth = 0
+
+
+class ConnectionPool:
+    # Long-lived connections, one per thread and database file because
+    # sqlite3 connections can't be shared between threads.  A connection is
+    # replaced when its file was removed or replaced.  reset() drops all
+    # connections, e.g., after the paths have changed.  Other threads close
+    # their connections on their next use.
+    def __init__(self):
+        self.local = threading.local()
+        self.generation = 0
+
+    def reset(self):
+        self.generation += 1
+        self.closeAll()
+
+    def closeAll(self):
+        # Only closes the connections of the current thread.
+        for entry in getattr(self.local, 'connections', {}).values():
+            entry.conn.close()
+        self.local.connections = {}
+        self.local.generation = self.generation
+
+    def connection(self, path):
+        if getattr(self.local, 'generation', None) != self.generation:
+            self.closeAll()
+        connections = self.local.connections
+        entry = connections.get(path)
+        if entry is not None:
+            if entry.depth:
+                # Still in use by an enclosing cursor
+                return entry
+            try:
+                st = os.stat(path)
+                if entry.inode == (st.st_dev, st.st_ino):
+                    return entry
+            except FileNotFoundError:
+                pass
+            entry.conn.close()
+            del connections[path]
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=busy_timeout,
+                               cached_statements=cached_statements)
+        for pragma in pragmas:
+            conn.execute(pragma)
+        st = os.stat(path)
+        entry = PooledConnection(conn, (st.st_dev, st.st_ino))
+        connections[path] = entry
+        return entry
+
+    @contextmanager
+    def cursor(self, path, *setup):
+        # The functions in "setup" are called with a cursor the first time
+        # the connection is used with them, e.g., to create tables.
+        # Uncommitted changes are rolled back at the end of the outermost
+        # cursor like closing a connection would.
+        entry = self.connection(path)
+        conn = entry.conn
+        c = conn.cursor()
+        entry.depth += 1
+        try:
+            for f in setup:
+                if f not in entry.done:
+                    f(c)
+                    entry.done.add(f)
+            yield c
+        finally:
+            c.close()
+            entry.depth -= 1
+            if not entry.depth and conn.in_transaction:
+                conn.rollback()
+
+
+pool = ConnectionPool()
@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Background jobs of the process, e.g., for retrieving quotes outside of
+# requests.  Each process of a multi-process server has its own jobs.
+
+from collections import deque
+import datetime
+import itertools
+import logging
+import queue
+import threading
+import traceback
+
+job_workers = 2
+# Number of finished jobs kept for the status
+max_finished_jobs = 50
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    __slots__ = ['id', 'name', 'args', 'fn', 'state', 'submitted', 'started',
+                 'finished', 'error', 'done']
+
+    def __init__(self, id, name, args, fn):
+        self.id = id
+        self.name = name
+        self.args = args
+        self.fn = fn
+        self.state = 'queued'
+        self.submitted = now()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        self.state = 'running'
+        self.started = now()
+        try:
+            self.fn(*self.args)
+            self.state = 'done'
+        except Exception:
+            self.state = 'failed'
+            self.error = traceback.format_exc().splitlines()[-1]
+            # Jobs run outside of requests, so the error wouldn't be seen
+            # otherwise.
+            logger.exception('Job %d %s%s failed', self.id, self.name,
+                             self.args)
+        self.finished = now()
+
+    def wait(self, timeout=None):
+        # Returns whether the job has finished.
+        return self.done.wait(timeout)
+
+    def toDict(self):
+        return {'id': self.id, 'name': self.name,
+                'args': [str(a) for a in self.args], 'state': self.state,
+                'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished, 'error': self.error}
+
+
+class JobRunner:
+    # Jobs are executed in the order of submission by a pool of worker
+    # threads that are started with the first job.  A job that is identical
+    # to a queued job isn't added again.  With "inline", jobs are executed
+    # when submitted, e.g., for tests.
+    def __init__(self):
+        self.inline = False
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.workers = []
+        self.ids = itertools.count(1)
+        self.queued = {}
+        self.running = {}
+        self.finished = deque(maxlen=max_finished_jobs)
+
+    def submit(self, name, fn, *args):
+        key = (name, args)
+        with self.lock:
+            job = self.queued.get(key)
+            if job is not None:
+                return job
+            job = Job(next(self.ids), name, args, fn)
+            self.queued[key] = job
+            if not self.inline:
+                self.queue.put(job)
+                if len(self.workers) < job_workers:
+                    worker = threading.Thread(target=self.work, daemon=True)
+                    worker.start()
+                    self.workers.append(worker)
+        if self.inline:
+            self.execute(job)
+        return job
+
+    def work(self):
+        while True:
+            self.execute(self.queue.get())
+
+    def execute(self, job):
+        with self.lock:
+            del self.queued[(job.name, job.args)]
+            self.running[job.id] = job
+        job.run()
+        with self.lock:
+            del self.running[job.id]
+            self.finished.append(job)
+        job.done.set()
+
+    def status(self):
+        with self.lock:
+            jobs = (list(self.finished) + list(self.running.values()) +
+                    list(self.queued.values()))
+        jobs.sort(key=lambda x: x.id)
+        return [job.toDict() for job in jobs]
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+runner = JobRunner()
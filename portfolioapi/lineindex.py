@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Date indexes of account files.  The index of a text file holds the byte
+# offset, the date, and the running maximum of the dates of each transaction
+# line so that the lines of a date window can be read from a memory-mapped
+# text file without parsing the lines before it:
+#
+#   header
+#   offset                int64
+#   date, end             int32
+#
+# Indexing stops at the first line that can't be parsed.  The header holds
+# the offset of that line ("tail") so that reads past the last transaction
+# parse it and raise the same error as a full read.  Like compiled files,
+# the header contains the fingerprint of the text file.
+
+from array import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+MAGIC = b'PTXI'
+VERSION = 1
+# magic, version, byte order, fingerprint (mtime_ns, size, inode),
+# number of transactions, offset of the tail
+header = struct.Struct('<4sHHqqqIq')
+byte_order = 1 if sys.byteorder == 'little' else 2
+
+
+class LineIndex:
+    def __init__(self, fingerprint, offsets, dates, ends, tail):
+        self.fingerprint = fingerprint
+        self.offsets = offsets
+        self.dates = dates
+        self.ends = ends
+        self.tail = tail
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def window(self, start, end):
+        # The byte range of the lines that may have dates after "start" up to
+        # and including "end".  Lines before the range have earlier dates
+        # and the range ends before the first line after the running maximum
+        # passes "end" like Transaction.read.  Out of order, the caller
+        # filters the lines by date.  Past the last transaction, the range
+        # includes the tail.
+        i = bisect.bisect_right(self.ends, start)
+        j = bisect.bisect_right(self.ends, end)
+        begin = self.offsets[i] if i < len(self) else self.tail
+        stop = self.offsets[j] if j < len(self) else self.fingerprint[1]
+        return (begin, max(begin, stop))
+
+
+def build(path, fingerprint, parse):
+    # "parse" returns an object with a date or None for lines without a
+    # transaction.
+    offsets = array('q')
+    dates = array('i')
+    ends = array('i')
+    end = None
+    tail = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            try:
+                t = parse(line.decode('utf-8'))
+            except Exception:
+                break
+            if t is not None:
+                end = t.date if end is None else max(end, t.date)
+                offsets.append(tail)
+                dates.append(t.date)
+                ends.append(end)
+            tail += len(line)
+    return LineIndex(fingerprint, offsets, dates, ends, tail)
+
+
+def load(path, fingerprint):
+    # Returns None if the file is missing, damaged, or out of date.
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    try:
+        (magic, version, order, mtime, size, ino, count,
+         tail) = header.unpack_from(data)
+        if (magic != MAGIC or version != VERSION or order != byte_order or
+            (mtime, size, ino) != tuple(fingerprint)):
+            return None
+        if header.size + count * (8 + 4 + 4) != len(data):
+            return None
+        view = memoryview(data)
+        offset = header.size
+        columns = []
+        for typecode, size in [('q', 8), ('i', 4), ('i', 4)]:
+            columns.append(view[offset:offset + count * size].cast(typecode))
+            offset += count * size
+        return LineIndex(fingerprint, *columns, tail)
+    except (struct.error, TypeError, ValueError):
+        return None
+
+
+def write(path, index):
+    dirname = os.path.dirname(path)
+    os.makedirs(dirname, exist_ok=True)
+    # See columnar.write
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.index-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header.pack(MAGIC, VERSION, byte_order, *index.fingerprint,
+                                len(index), index.tail))
+            for column in [index.offsets, index.dates, index.ends]:
+                f.write(column)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def readLines(path, fingerprint, begin, stop):
+    # The lines in a byte range of a memory-mapped text file.  Returns None
+    # if the file has changed since it was indexed.
+    if begin == stop:
+        return []
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if (st.st_mtime_ns, st.st_size, st.st_ino) != tuple(fingerprint):
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return str(buf[begin:stop], 'utf-8').splitlines()
@@ -1,25 +1,50 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+import bisect
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
 import copy
 import datetime
-from functools import reduce
+from functools import lru_cache
+import hashlib
+import heapq
 from itertools import groupby
-import json
 import math
+import multiprocessing
 import os
+import pickle
 import re
-import sqlite3
 import sys
+import threading
 
-from .stockquotes import getQuotes, getQuoteDates
+from . import columnar, lineindex, quotematrix, stockquotes
+from .connections import pool
+from .stockquotes import getDayQuotes, getQuotes, getQuoteDates
 
 EPOCH = datetime.date(1970, 1, 1)
 LONG_DAYS = 365
 cash_like = set(['SWVXX', 'FZCXX', 'MIP CL 1'])
 data_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'data')
 cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache')
+# Maximum number of parsed transaction files kept in memory.
+transaction_cache_size = 64
+# Store compiled account files in cache/compiled.
+compile_transactions = True
+# Store date indexes of account files in cache/index for reading date windows
+# of files that aren't in the transaction cache.
+index_transactions = True
+# Increment when a change makes stored checkpoints invalid.
+checkpoint_version = 3
+# Version of the tables of the history in the cache databases
+history_version = 1
+# Number of processes for replaying accounts in parallel (0: disabled) and
+# the minimum size in bytes of the account files to use them
+replay_processes = 0
+replay_threshold = 1 << 20
+replay_executor = None
+replay_lock = threading.Lock()
 
 
 def makeDict(obj, keys):
@@ -29,6 +54,8 @@ def makeDict(obj, keys):
 
 
 class Dividend:
+    __slots__ = ('date', 'amount')
+
     def __init__(self, date, amount):
         self.date = date
         self.amount = amount
@@ -36,6 +63,9 @@ class Dividend:
     def __str__(self):
         return '%d|%.2f' % (self.date, self.amount)
 
+    def clone(self):
+        return Dividend(self.date, self.amount)
+
     def toDict(self):
         data = {'date': Transaction.toDate(self.date).isoformat()}
         data.update(makeDict(self, ['amount']))
@@ -43,12 +73,19 @@ class Dividend:
 
 
 class Interest:
+    __slots__ = ('name', 'amount')
+
     def __init__(self, name, amount):
         self.name = name
         self.amount = amount
 
 
 class Lot:
+    # "account" is only set for lots of combined portfolios.
+    __slots__ = ('symbol', 'nshares', 'share_price', 'share_expense',
+                 'purchase_date', 'share_adj', 'wash_days', 'dividends',
+                 'return_of_capital', 'account')
+
     def __init__(self, symbol, nshares, share_price, share_expense, share_adj,
                  purchase_date):
         self.symbol = symbol
@@ -70,6 +107,23 @@ class Lot:
                 (self.symbol, self.nshares, self.share_price,
                  self.share_expense, self.purchase_date, self.share_adj))
 
+    def clone(self):
+        # Faster than copy.deepcopy.  Only the dividends are mutable.
+        lt = Lot.__new__(Lot)
+        lt.symbol = self.symbol
+        lt.nshares = self.nshares
+        lt.share_price = self.share_price
+        lt.share_expense = self.share_expense
+        lt.purchase_date = self.purchase_date
+        lt.share_adj = self.share_adj
+        lt.wash_days = self.wash_days
+        lt.dividends = [d.clone() for d in self.dividends]
+        lt.return_of_capital = [d.clone() for d in self.return_of_capital]
+        account = getattr(self, 'account', None)
+        if account is not None:
+            lt.account = account
+        return lt
+
     def toDict(self):
         data = makeDict(self, ['symbol', 'nshares', 'share_price',
                                'share_expense', 'share_adj', 'wash_days',
@@ -83,6 +137,11 @@ class Lot:
 
 
 class CompletedLot:
+    __slots__ = ('symbol', 'start_date', 'end_date', 'nshares',
+                 'start_share_price', 'end_share_price', 'start_share_expense',
+                 'end_share_expense', 'start_share_adj', 'end_share_adj',
+                 'wash_days', 'wash_sale', 'dividends', 'account')
+
     def __init__(self, lot, end_date, nshares, end_share_price,
                  end_share_expense, end_share_adj):
         self.symbol = lot.symbol
@@ -114,6 +173,26 @@ class CompletedLot:
                  self.end_share_adj, self.start_date, self.end_date,
                  self.wash_sale))
 
+    def clone(self):
+        clt = CompletedLot.__new__(CompletedLot)
+        clt.symbol = self.symbol
+        clt.start_date = self.start_date
+        clt.end_date = self.end_date
+        clt.nshares = self.nshares
+        clt.start_share_price = self.start_share_price
+        clt.end_share_price = self.end_share_price
+        clt.start_share_expense = self.start_share_expense
+        clt.end_share_expense = self.end_share_expense
+        clt.start_share_adj = self.start_share_adj
+        clt.end_share_adj = self.end_share_adj
+        clt.wash_days = self.wash_days
+        clt.wash_sale = self.wash_sale
+        clt.dividends = [d.clone() for d in self.dividends]
+        account = getattr(self, 'account', None)
+        if account is not None:
+            clt.account = account
+        return clt
+
     def getGain(self):
         return (round(self.nshares *
                       (self.end_share_price - self.start_share_price), 2) -
@@ -137,6 +216,9 @@ class CompletedLot:
 
 
 class Transaction:
+    __slots__ = ('date', 'type', 'name', 'name2', 'count', 'amount1',
+                 'amount2')
+
     def __init__(self, date, action_type, name):
         self.date = date
         self.type = action_type.lower()
@@ -159,6 +241,14 @@ class Transaction:
     def is_cash_like(self):
         return self.name in cash_like
 
+    def is_option(self):
+        return isOptionSymbol(self.name)
+
+    @property
+    def option(self):
+        # Parsed once per symbol, see getOptionParameters.
+        return getOptionParameters(self.name)
+
     @staticmethod
     def fromDate(d):
         # Internals dates are represented as the number of days since the epoch.
@@ -240,11 +330,10 @@ class Transaction:
     @staticmethod
     def readTransactions(filename, date=None, skip=None):
         skip_options = skip == 'options'
-        with open(filename, encoding='utf-8') as f:
-            try:
-                transactions = Transaction.read(f, date)
-            except Exception as e:
-                raise type(e)(str(e) + ' ' + filename)
+        try:
+            transactions = transaction_cache.get(filename).read(date)
+        except Exception as e:
+            raise type(e)(str(e) + ' ' + filename)
         # transactions.sort(key=lambda t: t.date)
         if skip_options:
             transactions2 = []
@@ -255,9 +344,11 @@ class Transaction:
                         # print(Transaction.toDate(k), t[0], t[1])
                         q = getQuotes(Transaction.toDate(k), set([t[0].name]),
                                       same_day=True)
-                        t[0].amount1 = q.get(t[0].name, 0)
-                        transactions2.append(t[0])
-                    elif not isOptionSymbol(t.name):
+                        # Don't modify the cached transaction.
+                        t2 = copy.copy(t[0])
+                        t2.amount1 = q.get(t[0].name, 0)
+                        transactions2.append(t2)
+                    elif not t.is_option():
                         # if t.name == 'MA':
                         #     print(Transaction.toDate(k), t)
                         transactions2.append(t)
@@ -280,14 +371,50 @@ class Transaction:
             transactions.append(t)
         return transactions
 
+    @staticmethod
+    def readTimeline(filename, date=None, skip=None):
+        # Like readTransactions but as a TransactionTimeline
+        if skip is not None:
+            return TransactionTimeline(
+                Transaction.readTransactions(filename, date, skip=skip))
+        try:
+            return transaction_cache.get(filename).timeline(date)
+        except Exception as e:
+            raise type(e)(str(e) + ' ' + filename)
+
+    @staticmethod
+    def readWindow(filename, start=-math.inf, end=None, skip=None):
+        # The transactions after "start" up to and including "end" as a
+        # TransactionTimeline.  A file that isn't in the transaction cache is
+        # read through its date index so that only the lines of the window
+        # are parsed.
+        if end is None:
+            end = Transaction.today()
+        if skip is not None:
+            return Transaction.readTimeline(filename, end, skip).range(start)
+        try:
+            path = os.path.realpath(filename)
+            st = os.stat(path)
+            fingerprint = (st.st_mtime_ns, st.st_size, st.st_ino)
+            lines = None
+            if (index_transactions and
+                transaction_cache.peek(path, fingerprint) is None):
+                lines = readIndexedLines(path, fingerprint, start, end)
+            if lines is None:
+                return transaction_cache.get(path).timeline(end).range(start)
+            transactions = []
+            for x in lines:
+                t = Transaction.parse(x)
+                # Out of order, the window may contain earlier dates.
+                if t is not None and t.date > start:
+                    transactions.append(t)
+            return TransactionTimeline(transactions)
+        except Exception as e:
+            raise type(e)(str(e) + ' ' + filename)
+
     @staticmethod
     def checkTransactions(trans):
-        prev = 0
-        for t in trans:
-            if t.date < prev:
-                return t
-            prev = t.date
-        return None
+        return TransactionTimeline(trans).bad
 
     @staticmethod
     def checkOptions(filename):
@@ -295,11 +422,11 @@ class Transaction:
         sales = defaultdict(list)
         for t in transactions:
             if ((t.type == 's' or t.type == 'b') and
-                not t.is_cash_like() and not isOptionSymbol(t.name)):
+                not t.is_cash_like() and not t.is_option()):
                 sales[t.name].append(t)
         for t in transactions:
             if (t.type == 's' or t.type == 'b') and t.amount1 == 0:
-                opt = getOptionParameters(t.name)
+                opt = t.option
                 if not opt[0]:
                     continue
                 for t2 in sales[opt[0]]:
@@ -309,6 +436,225 @@ class Transaction:
                         print('option', Transaction.toDate(t.date).isoformat(), str(t), ' ', str(t2))
 
 
+class TransactionFile:
+    # All transactions of a file in file order.  "ends" holds the running
+    # maximum of the dates so that the prefix returned by Transaction.read
+    # for a date can be found by bisection.
+    def __init__(self, fingerprint, transactions, error=None, ends=None):
+        self.fingerprint = fingerprint
+        self.transactions = transactions
+        if ends is None:
+            ends = []
+            end = -math.inf
+            for t in transactions:
+                end = max(end, t.date)
+                ends.append(end)
+        self.ends = ends
+        # Parse error after the last transaction.  It is only raised for
+        # dates that would have read past the transactions.
+        self.error = error
+        # Digests by prefix length
+        self.digests = None
+        # Dates and index of the first transaction out of order for
+        # timelines
+        self.days = None
+        self.unordered = None
+
+    @staticmethod
+    def parse(path, fingerprint):
+        transactions = []
+        error = None
+        with open(path, encoding='utf-8') as f:
+            try:
+                for x in f:
+                    t = Transaction.parse(x)
+                    if t is not None:
+                        transactions.append(t)
+            except Exception as e:
+                error = e
+        return TransactionFile(fingerprint, transactions, error)
+
+    @staticmethod
+    def load(path, fingerprint):
+        # Use the compiled file if it is up to date and compile it otherwise.
+        # Files with parse errors are never compiled.
+        compiled = os.path.join(cache_dir, 'compiled', os.path.basename(path))
+        transactions = columnar.load(compiled, fingerprint, Transaction)
+        if transactions is not None:
+            return TransactionFile(fingerprint, transactions,
+                                   ends=transactions.ends)
+        entry = TransactionFile.parse(path, fingerprint)
+        if entry.error is None and compile_transactions:
+            try:
+                columnar.write(compiled, fingerprint, entry.transactions)
+            except OSError:
+                pass
+        return entry
+
+    def read(self, date=None):
+        if date is None:
+            date = Transaction.today()
+        idx = bisect.bisect_right(self.ends, date)
+        if idx == len(self.transactions) and self.error is not None:
+            raise self.error
+        return self.transactions[:idx]
+
+    def timeline(self, date=None):
+        transactions = self.read(date)
+        n = len(transactions)
+        if self.days is None:
+            days = getattr(self.transactions, 'dates', None)
+            days = (list(days) if days is not None else
+                    [t.date for t in self.transactions])
+            # Dates before the running maximum are out of order.
+            self.unordered = next((i for i, (d, e)
+                                   in enumerate(zip(days, self.ends))
+                                   if d < e), len(days))
+            self.days = days
+        bad = transactions[self.unordered] if self.unordered < n else None
+        return TransactionTimeline(transactions, self.days[:n], bad)
+
+    def digest(self, date):
+        # Digest of the transactions read for "date" to validate checkpoints.
+        # The digests for all year ends are computed in a single pass.
+        idx = bisect.bisect_right(self.ends, date)
+        if self.digests is None:
+            digests = {}
+            h = hashlib.sha1()
+            year_end = None
+            for i, t in enumerate(self.transactions):
+                if year_end is None or self.ends[i] > year_end:
+                    digests[i] = h.hexdigest()
+                    year_end = Transaction.fromYearEnd(
+                        Transaction.toYear(self.ends[i]))
+                h.update(TransactionFile.digestKey(t))
+            digests[len(self.transactions)] = h.hexdigest()
+            self.digests = digests
+        digest = self.digests.get(idx)
+        if digest is None:
+            h = hashlib.sha1()
+            for t in self.transactions[:idx]:
+                h.update(TransactionFile.digestKey(t))
+            digest = self.digests[idx] = h.hexdigest()
+        return digest
+
+    @staticmethod
+    def digestKey(t):
+        return repr((t.date, t.type, t.name, t.name2, t.count, t.amount1,
+                     t.amount2)).encode()
+
+
+class TransactionTimeline:
+    # Transactions of an account in file order with their dates so that date
+    # ranges are found by bisection.  "bad" is the first transaction out of
+    # order.  Out-of-order timelines are filtered instead to keep the file
+    # order.
+    def __init__(self, transactions, days=None, bad=None):
+        self.transactions = transactions
+        if days is None:
+            days = [t.date for t in transactions]
+            bad = next((transactions[i] for i in range(1, len(days))
+                        if days[i] < days[i - 1]), None)
+        self.days = days
+        self.bad = bad
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __iter__(self):
+        return iter(self.transactions)
+
+    def __getitem__(self, key):
+        return self.transactions[key]
+
+    def range(self, start, end=math.inf):
+        # The transactions after "start" up to and including "end"
+        if self.bad is not None:
+            return TransactionTimeline([t for t in self.transactions
+                                        if t.date > start and t.date <= end])
+        i = bisect.bisect_right(self.days, start)
+        j = bisect.bisect_right(self.days, end)
+        return TransactionTimeline(self.transactions[i:j], self.days[i:j])
+
+    def day(self, date):
+        return self.range(date - 1, date)
+
+    def years(self):
+        # The year and the transactions of each year with transactions.  Out
+        # of order, consecutive transactions of the same year are grouped.
+        if self.bad is not None:
+            for k, g in groupby(self.transactions,
+                                key=lambda t: Transaction.toYear(t.date)):
+                yield (k, TransactionTimeline(list(g)))
+            return
+        i = 0
+        while i < len(self.days):
+            year = Transaction.toYear(self.days[i])
+            j = bisect.bisect_right(self.days, Transaction.fromYearEnd(year))
+            yield (year, TransactionTimeline(self.transactions[i:j],
+                                             self.days[i:j]))
+            i = j
+
+
+class TransactionCache:
+    # Process-wide LRU cache of parsed files.  Entries are keyed by the real
+    # path and only reused while modification time, size, and inode match.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename):
+        path = os.path.realpath(filename)
+        # Get the fingerprint before reading the file.  A concurrent change
+        # results in a newer entry that gets replaced on the next access.
+        st = os.stat(path)
+        fingerprint = (st.st_mtime_ns, st.st_size, st.st_ino)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry.fingerprint == fingerprint:
+                self.entries.move_to_end(path)
+                return entry
+        entry = TransactionFile.load(path, fingerprint)
+        with self.lock:
+            self.entries[path] = entry
+            self.entries.move_to_end(path)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def peek(self, path, fingerprint):
+        # The entry of a real path if it is up to date without loading it
+        with self.lock:
+            entry = self.entries.get(path)
+        if entry is not None and entry.fingerprint == fingerprint:
+            return entry
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+transaction_cache = TransactionCache(transaction_cache_size)
+
+
+def readIndexedLines(path, fingerprint, start, end):
+    # The lines of a text file in the date window of Transaction.readWindow
+    # using the index in cache/index.  The index is built if it is missing
+    # or out of date.  Returns None if the file changes while reading.
+    filename = os.path.join(cache_dir, 'index', os.path.basename(path))
+    index = lineindex.load(filename, fingerprint)
+    if index is None:
+        index = lineindex.build(path, fingerprint, Transaction.parse)
+        try:
+            lineindex.write(filename, index)
+        except OSError:
+            pass
+    begin, stop = index.window(start, end)
+    return lineindex.readLines(path, fingerprint, begin, stop)
+
+
 def adjustDividends(dividends, factor):
     for d in dividends:
         d.amount *= factor
@@ -319,6 +665,7 @@ def isOptionSymbol(symbol):
             symbol[-8:].isdigit() and symbol[-15:-9].isdigit())
 
 
+@lru_cache(maxsize=4096)
 def getOptionParameters(symbol):
     m = re.fullmatch(r'(.*)(\d{6})([PC])(\d{8})', symbol)
     if not m:
@@ -340,6 +687,150 @@ def getOptionPair(symbol):
     return (symbol,) if not opt[0] else (symbol, opt[0])
 
 
+class WashNode:
+    __slots__ = ('item', 'symbol', 'prev', 'next', 'symbol_prev',
+                 'symbol_next')
+
+    def __init__(self, item):
+        self.item = item
+        self.symbol = item.symbol
+        self.prev = None
+        self.next = None
+        self.symbol_prev = None
+        self.symbol_next = None
+
+
+class WashWindow:
+    # Lots or completed lots within the wash sale period.  The items are in
+    # a doubly linked list in the order of insertion and in another doubly
+    # linked list per symbol so that they can be looked up by symbol and
+    # removed or inserted in constant time.  "date_key" is the attribute
+    # that determines when an item leaves the window.
+    def __init__(self, date_key, items=()):
+        self.date_key = date_key
+        self.head = None
+        self.tail = None
+        # symbol: [head, tail]
+        self.symbols = {}
+        self.nodes = {}
+        for item in items:
+            self.append(item)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, item):
+        return item in self.nodes
+
+    def __iter__(self):
+        node = self.head
+        while node is not None:
+            yield node.item
+            node = node.next
+
+    def __getstate__(self):
+        # Avoid deep recursion when pickling the linked lists.
+        return (self.date_key, list(self))
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def items(self, symbol):
+        # Items of a symbol in the order of insertion.
+        items = []
+        node = self.symbols.get(symbol, (None, None))[0]
+        while node is not None:
+            items.append(node.item)
+            node = node.symbol_next
+        return items
+
+    def append(self, item):
+        self.insertAfter(None, item)
+
+    def insertAfter(self, item, new_item):
+        # Insert at the end if "item" is None.
+        if item is None:
+            prev = self.tail
+            symbol_prev = self.symbols.get(new_item.symbol, (None, None))[1]
+        else:
+            prev = self.nodes.get(item)
+            if prev is None:
+                raise ValueError('item not in wash sale window')
+            symbol_prev = prev
+        node = WashNode(new_item)
+        self.nodes[new_item] = node
+        self.link(node, prev)
+        self.linkSymbol(node, symbol_prev)
+
+    def remove(self, item):
+        node = self.nodes.pop(item, None)
+        if node is None:
+            raise ValueError('item not in wash sale window')
+        if node.prev is None:
+            self.head = node.next
+        else:
+            node.prev.next = node.next
+        if node.next is None:
+            self.tail = node.prev
+        else:
+            node.next.prev = node.prev
+        self.unlinkSymbol(node)
+
+    def trim(self, date):
+        # Remove items from the front up to the first one after "date".
+        while (self.head is not None and
+               getattr(self.head.item, self.date_key) <= date):
+            self.remove(self.head.item)
+
+    def reindex(self):
+        # Needed after the symbol of items has changed.
+        self.symbols = {}
+        node = self.head
+        while node is not None:
+            node.symbol = node.item.symbol
+            ends = self.symbols.get(node.symbol)
+            self.linkSymbol(node, ends[1] if ends else None)
+            node = node.next
+
+    def link(self, node, prev):
+        node.prev = prev
+        node.next = self.head if prev is None else prev.next
+        if node.next is None:
+            self.tail = node
+        else:
+            node.next.prev = node
+        if prev is None:
+            self.head = node
+        else:
+            prev.next = node
+
+    def linkSymbol(self, node, prev):
+        ends = self.symbols.setdefault(node.symbol, [None, None])
+        node.symbol_prev = prev
+        node.symbol_next = ends[0] if prev is None else prev.symbol_next
+        if node.symbol_next is None:
+            ends[1] = node
+        else:
+            node.symbol_next.symbol_prev = node
+        if prev is None:
+            ends[0] = node
+        else:
+            prev.symbol_next = node
+
+    def unlinkSymbol(self, node):
+        ends = self.symbols[node.symbol]
+        if node.symbol_prev is None:
+            ends[0] = node.symbol_next
+        else:
+            node.symbol_prev.symbol_next = node.symbol_next
+        if node.symbol_next is None:
+            ends[1] = node.symbol_prev
+        else:
+            node.symbol_next.symbol_prev = node.symbol_prev
+        if ends[0] is None:
+            del self.symbols[node.symbol]
+
+
 class Portfolio:
     def __init__(self, date, account=None):
         self.portfolio_date = date
@@ -365,9 +856,37 @@ class Portfolio:
         self.deposits = []
         # Track wash sales
         # Lot
-        self.recent_buys = []
+        self.recent_buys = WashWindow('purchase_date')
         # CompletedLot
-        self.recent_sells = []
+        self.recent_sells = WashWindow('end_date')
+
+    def __getstate__(self):
+        # For checkpoints.  "transactions" only holds the argument of the
+        # last call of fillLots and year_dividend has a lambda as default.
+        state = self.__dict__.copy()
+        state.pop('transactions', None)
+        state['year_dividend'] = {k: dict(v)
+                                  for k, v in self.year_dividend.items()}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.year_dividend = defaultdict(lambda: defaultdict(float))
+        for k, v in state['year_dividend'].items():
+            self.year_dividend[k].update(v)
+
+    def resetDate(self, date):
+        # Continue a restored portfolio for a later date.  Only transactions
+        # on or after the start of the year of "date" depend on it.  The
+        # values of an earlier year start over.
+        bg_year = Transaction.yearBegin(date)
+        if bg_year != self.bg_year:
+            self.first_deposit = bg_year + 366
+            self.interest = []
+            self.realized_long = 0
+            self.realized_short = 0
+        self.portfolio_date = date
+        self.bg_year = bg_year
 
     def emptyDeposits(self):
         self.deposits = []
@@ -400,7 +919,7 @@ class Portfolio:
 
     def splitLot(self, lt, nshares):
         factor = nshares / lt.nshares
-        lt2 = copy.deepcopy(lt)
+        lt2 = lt.clone()
         adjustDividends(lt2.dividends, 1 - factor)
         adjustDividends(lt2.return_of_capital, 1 - factor)
         adjustDividends(lt.dividends, factor)
@@ -418,16 +937,20 @@ class Portfolio:
 
     def splitCompletedLot(self, clt, nshares):
         factor = nshares / clt.nshares
-        clt2 = copy.deepcopy(clt)
+        clt2 = clt.clone()
         # CompletedLot doesn't have return_of_capital
         adjustDividends(clt2.dividends, 1 - factor)
         adjustDividends(clt.dividends, factor)
         clt2.nshares = clt.nshares - nshares
         clt.nshares = nshares
-        self.completed_lots.insert(self.completed_lots.index(clt) + 1, clt2)
-        idx = self.recent_sells.index(clt)
-        if idx >= 0:
-            self.recent_sells.insert(idx + 1, clt2)
+        # Wash sales only involve recent lots, so search from the end.
+        idx = len(self.completed_lots) - 1
+        while idx >= 0 and self.completed_lots[idx] is not clt:
+            idx -= 1
+        if idx < 0:
+            raise ValueError('completed lot not found')
+        self.completed_lots.insert(idx + 1, clt2)
+        self.recent_sells.insertAfter(clt, clt2)
         return clt2
 
     def sellLot(self, lt, sold_shares, share_price, share_expense, share_adj,
@@ -495,9 +1018,8 @@ class Portfolio:
         #     print('checkWashSell', [str(clt) for clt in completed])
         found = False
         for clt in completed:
-            matches = [lt for lt in self.recent_buys
-                       if lt.symbol == sym and
-                       lt.purchase_date != clt.start_date]
+            matches = [lt for lt in self.recent_buys.items(sym)
+                       if lt.purchase_date != clt.start_date]
             if not matches:
                 break
             found = True
@@ -528,9 +1050,9 @@ class Portfolio:
         #     print('match4', [(str(clt), clt.getGain()) for clt in completed], [str(lt) for lt in matches], [str(clt) for clt in self.recent_sells if clt.symbol == sym])
 
     def checkWashBuy(self, lt):
-        matches = [clt for clt in self.recent_sells
-                   if clt.symbol == lt.symbol and
-                   clt.start_date != lt.purchase_date and clt.getGain() < 0]
+        matches = [clt for clt in self.recent_sells.items(lt.symbol)
+                   if clt.start_date != lt.purchase_date and
+                   clt.getGain() < 0]
         if not matches:
             return
         # if lt.symbol == 'AAPL120317C00540000':
@@ -566,8 +1088,8 @@ class Portfolio:
             clt.wash_sale = -share_gain
             if remaining == 0:
                 break
-        matches = [clt for clt in self.recent_sells
-                   if clt.symbol == lt.symbol and clt.getGain() < 0]
+        matches = [clt for clt in self.recent_sells.items(lt.symbol)
+                   if clt.getGain() < 0]
         # print('match2', str(lt), [str(x) for x in self.recent_buys if x.symbol == lt.symbol],
         #       [str(clt) for clt in matches], [str(clt) for clt in completed])
 
@@ -853,6 +1375,7 @@ class Portfolio:
             # Same names should really be handled by 'x'.
             self.mergeLots(t.name2, lots)
             del self.lots[t.name]
+            self.recent_buys.reindex()
         for it in self.interest:
             if it.name == t.name:
                 it.name = t.name2
@@ -911,32 +1434,39 @@ class Portfolio:
 
     @staticmethod
     def matchOptions(group):
+        # Pair stock transactions with the assigned or exercised options of
+        # the same day.  Each stock transaction takes the first unmatched
+        # option with the same underlying and strike price that is either a
+        # put with the same action or a call with the opposite action.
         stocks = [idx for idx, t in enumerate(group)
-                  if (t.type == 'b' or t.type == 's') and
-                  not isOptionSymbol(t.name)]
-        while stocks:
-            idx1 = stocks.pop(0)
+                  if (t.type == 'b' or t.type == 's') and not t.is_option()]
+        if not stocks:
+            return group
+        options = defaultdict(deque)
+        for idx, t in enumerate(group):
+            if ((t.type == 'b' or t.type == 's') and t.amount1 == 0 and
+                t.is_option()):
+                opt = t.option
+                options[(opt[0], opt[3], opt[2], t.type)].append(idx)
+        if not options:
+            return group
+        matched = {}
+        for idx1 in stocks:
             t = group[idx1]
-            idx2 = -1
-            for i in range(len(group)):
-                if i == idx1:
-                    continue
-                t2 = group[i]
-                if (isinstance(t2, tuple) or
-                    (t2.type != 'b' and t2.type != 's') or t2.amount1 != 0):
-                    continue
-                opt = getOptionParameters(t2.name)
-                if (opt[0] == t.name and opt[3] == t.amount1 and
-                    (t2.type == t.type) == (opt[2] == 'P')):
-                    idx2 = i
-                    break
-            if idx2 >= 0:
-                group[idx1] = (t, group[idx2])
-                group.pop(idx2)
-                for i in range(len(stocks)):
-                    if stocks[i] > idx2:
-                        stocks[i] -= 1
-        return group
+            other = 's' if t.type == 'b' else 'b'
+            candidates = [q for q in [options.get((t.name, t.amount1, 'P',
+                                                   t.type)),
+                                      options.get((t.name, t.amount1, 'C',
+                                                   other))]
+                          if q]
+            if candidates:
+                q = min(candidates, key=lambda q: q[0])
+                matched[idx1] = q.popleft()
+        if not matched:
+            return group
+        options = set(matched.values())
+        return [(t, group[matched[idx]]) if idx in matched else t
+                for idx, t in enumerate(group) if idx not in options]
 
     def fillLots(self, transactions):
         # This is the main method for adding transactions to the portfolio.
@@ -944,14 +1474,8 @@ class Portfolio:
         year = 0
         year_end = 0
         for k, g in groupby(transactions, lambda t: t.date):
-            idx = next((i for i, lt in enumerate(self.recent_buys)
-                        if lt.purchase_date > k - 31),
-                       len(self.recent_buys))
-            del self.recent_buys[:idx]
-            idx = next((i for i, lt in enumerate(self.recent_sells)
-                        if lt.end_date > k - 31),
-                       len(self.recent_sells))
-            del self.recent_sells[:idx]
+            self.recent_buys.trim(k - 31)
+            self.recent_sells.trim(k - 31)
             # The transactions have to be kept in order other than matching
             # stocks with options.
             group = Portfolio.matchOptions(list(g))
@@ -1101,8 +1625,53 @@ class Portfolio:
         return [a for a in accounts if a[2]]
 
     @staticmethod
-    def getHistory(account, account_transfers, start=0, end=None,
-                   include_positions=False):
+    def replay(date, account, account_transfers, skip=None):
+        # Fills the portfolio of an account including the accounts
+        # transferred into it.  Returns the portfolio (None without any
+        # transactions) and the first transaction out of order.  The state at
+        # each year end is kept as a checkpoint so that later calls only
+        # replay the transactions after the last year end.
+        trans = Transaction.readTimeline(os.path.join(data_dir, account),
+                                         date, skip=skip)
+        bad = trans.bad
+        accounts = Portfolio.readTransfers(date, account, account_transfers,
+                                           skip=skip)
+        if not trans and not accounts:
+            return (None, bad)
+        portfolio = Portfolio(date, account)
+        start = 0
+        # Checkpoints need the transactions in order.  Skipping options
+        # depends on quotes.
+        checkpoints = None
+        if bad is None and skip is None:
+            checkpoints = Checkpoints(account, date, accounts)
+            checkpoint = checkpoints.load()
+            if checkpoint is not None:
+                start, portfolio = checkpoint
+                portfolio.resetDate(date)
+        accounts = [a for a in accounts if a[0] > start]
+        points = set(a[0] for a in accounts)
+        if checkpoints:
+            points.update(d for d in checkpoints.digests if d > start)
+        for point in sorted(points):
+            portfolio.fillLots(trans.range(start, point))
+            start = point
+            for end, _, trans2 in accounts:
+                if end == point:
+                    p = Portfolio(end)
+                    p.fillLots(trans2)
+                    portfolio = Portfolio.combine([portfolio, p])
+            if checkpoints:
+                checkpoints.add(point, portfolio)
+        portfolio.fillLots(trans.range(start))
+        if checkpoints:
+            checkpoints.save()
+        return (portfolio, bad)
+
+    @staticmethod
+    def updateHistories(account, account_transfers, end=None):
+        # Updates the history of the account and of the accounts transferred
+        # into it.  Returns the transfer dates and accounts.
         end = end or Transaction.today()
         accounts = [(Transaction.parseDate(a[0]), a[1])
                     for a in account_transfers
@@ -1111,47 +1680,54 @@ class Portfolio:
         for a in accounts:
             updateHistory(a[1], date=a[0])
         updateHistory(account, date=end, accounts=accounts)
+        return accounts
+
+    @staticmethod
+    def getHistory(account, start=0, end=None, include_positions=False,
+                   account_transfers=None):
+        return list(Portfolio.iterHistory(account, start, end,
+                                          include_positions,
+                                          account_transfers))
+
+    @staticmethod
+    def iterHistory(account, start=0, end=None, include_positions=False,
+                    account_transfers=None):
+        # Updates the history and returns an iterator over its days.
+        end = end or Transaction.today()
+        if account_transfers is None:
+            account_transfers = Portfolio.get_transfers(data_dir)
+        accounts = Portfolio.updateHistories(account, account_transfers, end)
         # Don't include the merge day because it's already in the merged
         # account.
         accounts = [(end, account)] + [(a[0] - 1, a[1]) for a in accounts]
-        columns = ['date', 'equity', 'cash', 'deposits']
-        if include_positions:
-            columns.append('positions')
-        account_rows = []
+        return mergeHistories(accounts, start, include_positions)
+
+    @staticmethod
+    def getSymbolHistory(account, symbol, start=0, end=None,
+                         account_transfers=None):
+        # Shares and quotes of one symbol on the days it was held
+        end = end or Transaction.today()
+        if account_transfers is None:
+            account_transfers = Portfolio.get_transfers(data_dir)
+        accounts = Portfolio.updateHistories(account, account_transfers, end)
+        accounts = [(end, account)] + [(a[0] - 1, a[1]) for a in accounts]
+        shares = defaultdict(float)
+        quotes = {}
         for a in accounts:
-            cursor = getCursor(os.path.join(cache_dir, '{0}.db'.format(a[1])))
-            try:
-                cursor.execute('SELECT {0} FROM positions WHERE date>=? AND date<=?'
-                               .format(','.join(columns)),
-                               [start, a[0]])
-                rows = cursor.fetchall()
-                if include_positions:
-                    rows = [r[:4] + (json.loads(r[4]),) for r in rows]
-                account_rows.append(rows)
-            finally:
-                cursor.connection.close()
-        n = len(account_rows)
-        if n == 1:
-            rows = account_rows[0]
-        else:
-            dates = sorted(reduce(lambda x, y: x | set(z[0] for z in y),
-                                  account_rows, set()))
-            rows = []
-            indices = [0] * n
-            for d in dates:
-                entries = []
-                for i in range(n):
-                    if (indices[i] < len(account_rows[i]) and
-                        account_rows[i][indices[i]][0] == d):
-                        entries.append(account_rows[i][indices[i]])
-                        indices[i] += 1
-                rows.append(mergeHistoryEntries(entries))
-        return [{c: (Transaction.toDate(r[i]).isoformat() if i == 0 else r[i])
-                 for i, c in enumerate(columns)}
-                for r in rows]
+            with getCursor(os.path.join(cache_dir, '{0}.db'.format(a[1]))) as cursor:
+                cursor.execute('SELECT date,shares,quote FROM holdings '
+                               'WHERE symbol=? AND date>=? AND date<=?',
+                               [symbol, start, a[0]])
+                for d, n, q in cursor.fetchall():
+                    shares[d] += n
+                    quotes[d] = q
+        return [{'date': Transaction.toDate(d).isoformat(), 'shares': shares[d],
+                 'quote': quotes[d], 'value': round(shares[d] * quotes[d], 2)}
+                for d in sorted(shares)]
 
     @staticmethod
-    def clearHistory(account, account_transfers=[]):
+    def clearHistory(account, account_transfers=[], since=None):
+        # Removes the history from "since" or all of it.
         if account == 'all':
             accounts = [x[:-3] for x in os.listdir(cache_dir)
                         if x != 'quotes.db' and x.endswith('.db')]
@@ -1163,24 +1739,190 @@ class Portfolio:
         for a in accounts:
             path = os.path.join(cache_dir, '{0}.db'.format(a))
             if os.path.exists(path):
-                dropPositionsTable(getCursor(path))
+                with getCursor(path) as c:
+                    if since is None:
+                        dropPositionsTable(c)
+                    else:
+                        deletePositions(c, since)
+
+
+class ForwardReplay:
+    # Portfolios of an account at increasing dates, e.g., year ends, from a
+    # single replay of its transactions.  Accounts transferred into it are
+    # included before their transfer date, too.  Only the transactions on
+    # the portfolio date depend on it: they change the daily differences and
+    # new deposits instead of cash.  Those changes are reverted when moving
+    # to a later date and the values of the year start over in a new year
+    # so that each portfolio matches one filled from the start for its date.
+    def __init__(self, trans, accounts=()):
+        # "trans" is a TransactionTimeline.
+        self.trans = trans
+        self.current = None
+        self.start = 0
+        self.changes = None
+        self.transfers = deque((d, ForwardReplay(TransactionTimeline(trans2)))
+                               for d, _, trans2 in accounts)
+
+    def portfolio(self, date):
+        # The result is only valid until the next call.
+        self.setDate(date)
+        while self.transfers and self.transfers[0][0] <= date:
+            end, replay = self.transfers.popleft()
+            self.fill(end)
+            self.current = Portfolio.combine([self.current,
+                                              replay.portfolio(end)])
+        self.fill(date)
+        return Portfolio.combine([self.current] +
+                                 [replay.portfolio(date)
+                                  for _, replay in self.transfers])
+
+    def setDate(self, date):
+        p = self.current
+        if p is None:
+            self.current = Portfolio(date)
+        else:
+            cash_diff, cash_like_diff, equity_diff, new_deposits = self.changes
+            p.cash_diff -= cash_diff
+            p.cash_like_diff -= cash_like_diff
+            p.equity_diff -= equity_diff
+            p.new_deposits -= new_deposits
+            p.cash += new_deposits
+            p.resetDate(date)
+        self.changes = (0, 0, 0, 0)
+
+    def fill(self, end):
+        p = self.current
+        before = (p.cash_diff, p.cash_like_diff, p.equity_diff,
+                  p.new_deposits)
+        p.fillLots(self.trans.range(self.start, end))
+        after = (p.cash_diff, p.cash_like_diff, p.equity_diff, p.new_deposits)
+        self.changes = tuple(c + a - b for c, a, b
+                             in zip(self.changes, after, before))
+        self.start = end
+
+
+def replayAccounts(date, accounts, account_transfers, skip=None):
+    # Portfolio.replay for each account, in parallel processes if enabled and
+    # the accounts are large enough to make up for the overhead.
+    executor = getReplayExecutor(accounts, account_transfers)
+    if executor is None:
+        return [Portfolio.replay(date, a, account_transfers, skip=skip)
+                for a in accounts]
+    paths = (data_dir, cache_dir, stockquotes.quote_dir, stockquotes.quote_db)
+    futures = [executor.submit(replayAccount, paths, date, a,
+                               account_transfers, skip) for a in accounts]
+    results = []
+    for f in futures:
+        portfolio, transactions, bad = f.result()
+        if portfolio is not None:
+            # Not part of the pickled state
+            portfolio.transactions = transactions
+        results.append((portfolio, bad))
+    return results
+
+
+def replayAccount(paths, date, account, account_transfers, skip):
+    # Executed in a worker process
+    if paths != (data_dir, cache_dir, stockquotes.quote_dir,
+                 stockquotes.quote_db):
+        setDataPaths(*paths[:2])
+        stockquotes.setQuotePaths(*paths[2:])
+    portfolio, bad = Portfolio.replay(date, account, account_transfers,
+                                      skip=skip)
+    return (portfolio, getattr(portfolio, 'transactions', None), bad)
+
+
+def getReplayExecutor(accounts, account_transfers):
+    global replay_executor
+    if replay_processes <= 0 or len(accounts) < 2:
+        return None
+    # Including the accounts transferred into them
+    names = set(accounts)
+    names.update(a[1] for a in account_transfers if a[2] in names)
+    size = 0
+    for name in names:
+        try:
+            size += os.path.getsize(os.path.join(data_dir, name))
+        except OSError:
+            pass
+    if size < replay_threshold:
+        return None
+    with replay_lock:
+        if replay_executor is None:
+            # Forking a multi-threaded server isn't safe.
+            replay_executor = ProcessPoolExecutor(
+                replay_processes, multiprocessing.get_context('spawn'))
+        return replay_executor
+
+
+def setReplayProcesses(processes, threshold=None):
+    global replay_processes, replay_threshold, replay_executor
+    with replay_lock:
+        if replay_executor is not None:
+            replay_executor.shutdown(wait=False)
+            replay_executor = None
+        replay_processes = processes
+        if threshold is not None:
+            replay_threshold = threshold
+
+
+def mergeHistories(accounts, start, include_positions):
+    # Merges the date-ordered histories of the accounts without loading them.
+    # "accounts" holds the end date and the account.
+    columns = ['date', 'equity', 'cash', 'deposits']
+    if include_positions:
+        columns.append('positions')
+    with ExitStack() as stack:
+        histories = []
+        for end, a in accounts:
+            cursor = stack.enter_context(
+                getCursor(os.path.join(cache_dir, '{0}.db'.format(a))))
+            histories.append(accountHistory(cursor, start, end,
+                                            include_positions))
+        if len(histories) == 1:
+            rows = histories[0]
+        else:
+            rows = (mergeHistoryEntries(list(g)) for _, g in groupby(
+                heapq.merge(*histories, key=lambda r: r[0]),
+                key=lambda r: r[0]))
+        for r in rows:
+            yield {c: (Transaction.toDate(r[i]).isoformat() if i == 0 else r[i])
+                   for i, c in enumerate(columns)}
+
+
+def accountHistory(cursor, start, end, include_positions):
+    # Rows of the history of an account ordered by date
+    rows = cursor.execute('SELECT date,equity,cash,deposits FROM positions '
+                          'WHERE date>=? AND date<=? ORDER BY date',
+                          [start, end])
+    if not include_positions:
+        yield from rows
+        return
+    holdings = cursor.connection.execute(
+        'SELECT date,symbol,shares,quote FROM holdings '
+        'WHERE date>=? AND date<=? ORDER BY date,symbol', [start, end])
+    h = next(holdings, None)
+    for r in rows:
+        positions = []
+        while h is not None and h[0] <= r[0]:
+            if h[0] == r[0]:
+                positions.append(list(h[1:]))
+            h = next(holdings, None)
+        yield r + (positions,)
 
 
 def mergeHistoryEntries(entries):
-    # date, equity, cash, deposits, positions
+    # date, equity, cash, deposits, positions ordered by symbol
     if len(entries) == 1:
         return entries[0]
     merged = [entries[0][0]] + [sum(e[i] for e in entries) for i in range(1, 4)]
     if len(entries[0]) > 4:
-        quotes = {}
-        positions = defaultdict(float)
-        for e in entries:
-            data = e[4]
-            for p in data:
-                quotes[p[0]] = p[2]
-                positions[p[0]] += p[1]
-        symbols = sorted(positions.keys())
-        merged.append([[s, positions[s], quotes[s]] for s in symbols])
+        # The last quote of a symbol is used as before.
+        merged.append([[s, sum(p[1] for p in g), g[-1][2]] for s, g in
+                       ((s, list(g)) for s, g in groupby(
+                           heapq.merge(*(e[4] for e in entries),
+                                       key=lambda p: p[0]),
+                           key=lambda p: p[0]))])
     return merged
 
 
@@ -1192,16 +1934,19 @@ def updateHistory(account, date=None, accounts=[]):
                  Transaction.readTransactions(os.path.join(data_dir, a[1]), a[0]))
                 for a in accounts]
     accounts = [a for a in accounts if a[2]]
-    # Process merged portfolios until merge dates
-    portfolios = [Portfolio(a[0]) for a in accounts]
-    for i, a in enumerate(accounts):
-        portfolios[i].fillLots(a[2])
-    c = getCursor(os.path.join(cache_dir, '{0}.db'.format(account)))
-    try:
+    with getCursor(os.path.join(cache_dir, '{0}.db'.format(account))) as c:
         portfolio = Portfolio(date)
         portfolio.account = account
+        c.execute('PRAGMA user_version')
+        if c.fetchone()[0] != history_version:
+            dropPositionsTable(c)
+            c.execute('PRAGMA user_version={0}'.format(history_version))
         createPositionsTable(c)
-        trans = Transaction.readTransactions(os.path.join(data_dir, account), date)
+        createHoldingsTable(c)
+        # Hold the write lock from the start so that concurrent updates, e.g.,
+        # by a background job, don't add the same days.
+        c.execute('BEGIN IMMEDIATE')
+        trans = Transaction.readTimeline(os.path.join(data_dir, account), date)
         if not trans:
             return
         start = trans[0].date
@@ -1215,61 +1960,254 @@ def updateHistory(account, date=None, accounts=[]):
             start = max(start, row[0])
         quote_dates = getQuoteDates(Transaction.toDate(start + 1),
                                     Transaction.toDate(date))
-        # Always fill the lots from the beginning.
+        if not quote_dates:
+            return
+        # Continue from the portfolio stored with the last positions if the
+        # transactions up to that date are unchanged.  Otherwise, fill the
+        # lots from the beginning.
         start = 0
-        quotes = {}
+        digest = None
+        if trans.bad is None:
+            entry = transaction_cache.get(os.path.join(data_dir, account))
+            transfers = [(a[0], a[1], transaction_cache.get(
+                os.path.join(data_dir, a[1])).digest(a[0])) for a in accounts]
+            digest = lambda d: stateDigest(entry, transfers, d)
+            state = None
+            if row[0]:
+                state = loadHistoryState(c, row[0], digest(row[0]))
+            if state is not None:
+                portfolio = state
+                start = row[0]
+                # Deposits of the account on the previous portfolio date are
+                # regular cash now.  Deposits of transferred accounts on the
+                # transfer date remain in new_deposits as in a full replay.
+                d = portfolio.portfolio_date
+                if d <= start:
+                    amount = sum(t.amount1 for t in trans.day(d)
+                                 if t.type == 'd')
+                    portfolio.cash += amount
+                    portfolio.new_deposits -= amount
+                portfolio.resetDate(date)
+        days = []
         for d in quote_dates:
             end = Transaction.fromDate(d)
-            portfolio.fillLots([t for t in trans
-                                if t.date > start and t.date <= end])
-            for i, a in enumerate(accounts):
+            portfolio.fillLots(trans.range(start, end))
+            for a in accounts:
                 if a[0] > start and a[0] <= end:
-                    portfolio = Portfolio.combine([portfolio,
-                                                   portfolios[i]])
+                    # Process merged portfolios until merge dates
+                    p = Portfolio(a[0])
+                    p.fillLots(a[2])
+                    portfolio = Portfolio.combine([portfolio, p])
             positions = [(k, n) for k, n
                          in ((k, sum(lt.nshares for lt in v))
                              for k, v in portfolio.lots.items())
                          if n]
             positions.sort()
-            # Use quotes from previous days if current quotes are missing
-            quotes.update(getQuotes(d, [p[0] for p in positions] if positions
-                                    else {}, same_day=True))
-            positions = [(p[0], p[1], quotes.get(p[0], 0)) for p in positions]
-            equity = round(sum(p[1] * p[2] for p in positions), 2)
-            cash = round(portfolio.cash + portfolio.cash_like, 2)
-            deposits = round(portfolio.total_deposits, 2)
-            c.execute('INSERT INTO positions '
-                      '(date,equity,cash,deposits,positions) '
-                      'VALUES(?,?,?,?,?)',
-                      (end, equity, cash, deposits,
-                       json.dumps(positions, separators=(',',':'))))
-            # print(d, data)
+            # Deposits on the portfolio date are cash on later days, too.
+            days.append((d, end, positions,
+                         round(portfolio.cash + portfolio.cash_like +
+                               portfolio.new_deposits, 2),
+                         round(portfolio.total_deposits, 2)))
             start = end
+        # Get the quotes of all days at once.  As with getQuotes, quotes are
+        # only updated for current positions, or for all symbols if there are
+        # no positions, and older quotes are used if current quotes are
+        # missing.  Quotes on days without positions only matter for symbols
+        # held later.
+        wanted = []
+        later = set()
+        for d, end, positions, cash, deposits in reversed(days):
+            if positions:
+                symbols = [p[0] for p in positions]
+                later.update(symbols)
+            else:
+                symbols = sorted(later)
+            wanted.append((d, symbols))
+        rows = getDayQuotes(wanted)
+        # Continue with the quotes stored with the last positions of the
+        # symbols as if the earlier days were part of this update.
+        initial = {}
+        if row[0]:
+            for s in sorted(later):
+                c.execute('SELECT quote FROM holdings WHERE symbol=? AND '
+                          'date<=? ORDER BY date DESC LIMIT 1', [s, row[0]])
+                q = c.fetchone()
+                if q:
+                    initial[s] = q[0]
+        history = []
+        holdings = []
+        if quotematrix.enabled:
+            matrix = quotematrix.QuoteMatrix([x[0] for x in days],
+                                             sorted(later), rows, initial)
+            equities = matrix.value(matrix.counts([x[2] for x in days]))
+            for i, (d, end, positions, cash, deposits) in enumerate(days):
+                quotes = matrix.quotes(i, [p[0] for p in positions])
+                holdings.extend((end, p[0], p[1], q)
+                                for p, q in zip(positions, quotes))
+                history.append((end, round(float(equities[i]), 2), cash,
+                                deposits))
+        else:
+            quotes = dict(initial)
+            idx = 0
+            for d, end, positions, cash, deposits in days:
+                ds = d.isoformat()
+                while idx < len(rows) and rows[idx][0] == ds:
+                    quotes[rows[idx][1]] = rows[idx][2]
+                    idx += 1
+                positions = [(end, p[0], p[1], quotes.get(p[0], 0))
+                             for p in positions]
+                equity = round(sum(p[2] * p[3] for p in positions), 2)
+                holdings.extend(positions)
+                history.append((end, equity, cash, deposits))
+        c.executemany('INSERT INTO positions (date,equity,cash,deposits) '
+                      'VALUES(?,?,?,?)', history)
+        c.executemany('INSERT INTO holdings (date,symbol,shares,quote) '
+                      'VALUES(?,?,?,?)', holdings)
+        if digest is not None:
+            saveHistoryState(c, days[-1][1], digest(days[-1][1]), portfolio)
         c.connection.commit()
-    finally:
-        c.connection.close()
 
 
-def getCursor(name):
-    os.makedirs(os.path.dirname(name), exist_ok=True)
-    conn = sqlite3.connect(name)
-    return conn.cursor()
+def getCursor(name, *setup):
+    # Context manager for a cursor of the pooled connection of the current
+    # thread.  See ConnectionPool.cursor for "setup".
+    return pool.cursor(name, *setup)
+
+
+class Checkpoints:
+    # Portfolio states at year ends stored in the cache database of an
+    # account.  A checkpoint is valid while the digest of the transactions up
+    # to its date, including transferred accounts, is unchanged.  The state
+    # at a year end doesn't depend on the portfolio date as long as that is
+    # in a later year.
+    def __init__(self, account, date, accounts):
+        self.path = os.path.join(cache_dir, '{0}.db'.format(account))
+        entry = transaction_cache.get(os.path.join(data_dir, account))
+        transfers = [(d, a, transaction_cache.get(
+            os.path.join(data_dir, a)).digest(d)) for d, a, _ in accounts]
+        first = min([t.date for t in entry.transactions[:1]] +
+                    [d for d, _, _ in transfers])
+        self.digests = {}
+        for y in range(Transaction.toYear(first), Transaction.toYear(date)):
+            end = Transaction.fromYearEnd(y)
+            self.digests[end] = stateDigest(entry, transfers, end)
+        self.stored = {}
+        self.states = []
+
+    def load(self):
+        # Returns the date and portfolio of the latest valid checkpoint.
+        if not self.digests:
+            return None
+        with getCursor(self.path, createCheckpointsTable) as c:
+            c.execute('SELECT date,digest FROM checkpoints')
+            self.stored = dict(c.fetchall())
+            for d in sorted(self.digests, reverse=True):
+                if self.stored.get(d) == self.digests[d]:
+                    c.execute('SELECT state FROM checkpoints WHERE date=?',
+                              [d])
+                    try:
+                        return (d, pickle.loads(c.fetchone()[0]))
+                    except Exception:
+                        # Ignore checkpoints that can't be restored.
+                        del self.stored[d]
+        return None
+
+    def add(self, date, portfolio):
+        digest = self.digests.get(date)
+        if digest is not None and self.stored.get(date) != digest:
+            self.states.append((date, digest, pickle.dumps(portfolio)))
+
+    def save(self):
+        if not self.states:
+            return
+        with getCursor(self.path, createCheckpointsTable) as c:
+            c.executemany('INSERT OR REPLACE INTO checkpoints '
+                          '(date,digest,state) VALUES(?,?,?)', self.states)
+            c.connection.commit()
+        self.states = []
+
+
+def stateDigest(entry, transfers, date):
+    # Digest of the transactions up to "date" of an account and of the
+    # accounts transferred into it.  "transfers" holds the transfer date,
+    # the account, and the digest of its transactions.
+    h = hashlib.sha1(('%d|%s' % (checkpoint_version,
+                                 entry.digest(date))).encode())
+    for d, a, digest in transfers:
+        if d <= date:
+            h.update(('|%d|%s|%s' % (d, a, digest)).encode())
+    return h.hexdigest()
+
+
+def loadHistoryState(cursor, date, digest):
+    # Returns the portfolio stored with the positions of "date" if the
+    # transactions are unchanged.
+    createHistoryStateTable(cursor)
+    cursor.execute('SELECT state FROM history_state WHERE date=? AND digest=?',
+                   [date, digest])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    try:
+        return pickle.loads(row[0])
+    except Exception:
+        return None
+
+
+def saveHistoryState(cursor, date, digest, portfolio):
+    createHistoryStateTable(cursor)
+    cursor.execute('DELETE FROM history_state')
+    cursor.execute('INSERT INTO history_state (date,digest,state) '
+                   'VALUES(?,?,?)', (date, digest, pickle.dumps(portfolio)))
+
+
+def createHistoryStateTable(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS history_state '
+                   '(date INTEGER PRIMARY KEY, digest TEXT, state BLOB)')
+
+
+def createCheckpointsTable(cursor):
+    cursor.execute('CREATE TABLE IF NOT EXISTS checkpoints '
+                   '(date INTEGER PRIMARY KEY, digest TEXT, state BLOB)')
 
 
 def createPositionsTable(cursor):
     cursor.execute('CREATE TABLE IF NOT EXISTS positions '
                    '(date INTEGER PRIMARY KEY, equity REAL, cash REAL, '
-                   'deposits REAL, positions TEXT)')
+                   'deposits REAL)')
+
+
+def createHoldingsTable(cursor):
+    # Positions on the days in the positions table
+    cursor.execute('CREATE TABLE IF NOT EXISTS holdings '
+                   '(date INTEGER, symbol TEXT, shares REAL, quote NUMBER, '
+                   'PRIMARY KEY (date, symbol))')
+    cursor.execute('CREATE INDEX IF NOT EXISTS holdings_symbol '
+                   'ON holdings (symbol, date)')
 
 
 def dropPositionsTable(cursor):
     cursor.execute('DROP TABLE IF EXISTS positions')
+    cursor.execute('DROP TABLE IF EXISTS holdings')
+    cursor.execute('DROP TABLE IF EXISTS history_state')
+
+
+def deletePositions(cursor, since):
+    createPositionsTable(cursor)
+    createHoldingsTable(cursor)
+    createHistoryStateTable(cursor)
+    cursor.execute('DELETE FROM positions WHERE date>=?', [since])
+    cursor.execute('DELETE FROM holdings WHERE date>=?', [since])
+    cursor.execute('DELETE FROM history_state WHERE date>=?', [since])
+    cursor.connection.commit()
 
 
 def setDataPaths(data_path, cache_path):
     global data_dir, cache_dir
     data_dir = data_path
     cache_dir = cache_path
+    transaction_cache.clear()
+    pool.reset()
 
 
 def main2(argv):
@@ -1280,8 +2218,9 @@ def main2(argv):
     files = Portfolio.get_files(data_dir, argv[1], account_transfers, date)
     portfolios = []
     for f in files:
-        trans = Transaction.readTransactions(os.path.join(data_dir, f), date,
-                                             skip=skip)
+        # Only the transactions up to the date are read from the files.
+        trans = Transaction.readWindow(os.path.join(data_dir, f), end=date,
+                                       skip=skip)
         # print(trans[-1])
         # print([str(t) for t in trans[-4:]])
         append = bool(trans)
@@ -1294,10 +2233,9 @@ def main2(argv):
         start = 0
         for a in accounts:
             end = a[0]
-            portfolio.fillLots([t for t in trans
-                                if t.date > start and t.date <= end])
+            portfolio.fillLots(trans.range(start, end))
             start = end
-            trans2 = Transaction.readTransactions(os.path.join(data_dir, a[1]), a[0], skip=skip)
+            trans2 = Transaction.readWindow(os.path.join(data_dir, a[1]), end=a[0], skip=skip)
             if trans2:
                 append = True
                 p = Portfolio(a[0])
@@ -1305,7 +2243,7 @@ def main2(argv):
                 p.fillLots(trans2)
                 portfolio = Portfolio.combine([portfolio, p])
                 portfolio.account = f
-        portfolio.fillLots([t for t in trans if t.date > start])
+        portfolio.fillLots(trans.range(start))
         if append:
             portfolios.append(portfolio)
             # print(f)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Quotes of many symbols and days as a NumPy matrix for valuing positions
+# over date ranges.  NumPy is optional.  Without it, "enabled" is False and
+# callers use the quote dictionaries.
+
+import bisect
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .stockquotes import getDateQuotes, getQuoteDates, getQuotes
+
+enabled = numpy is not None
+
+
+class QuoteMatrix:
+    # Dense float64 matrix with a row per date and a column per symbol.
+    # "rows" holds (ISO date, symbol, quote) as returned by the quote
+    # database.  Gaps are filled with the previous quote of a symbol, or the
+    # quote in "initial".  Symbols without any quote so far have the quote 0.
+    def __init__(self, dates, symbols, rows, initial=None):
+        self.dates = list(dates)
+        self.symbols = list(symbols)
+        self.columns = {s: i for i, s in enumerate(self.symbols)}
+        n, m = len(self.dates), len(self.symbols)
+        index = {d.isoformat(): i for i, d in enumerate(self.dates)}
+        prices = numpy.full((n, m), numpy.nan)
+        for d, s, q in rows:
+            i = index.get(d)
+            j = self.columns.get(s)
+            if i is not None and j is not None:
+                prices[i, j] = q
+        self.initial = dict(initial or {})
+        first = numpy.zeros(m)
+        known = numpy.zeros(m, dtype=bool)
+        for s, q in self.initial.items():
+            j = self.columns.get(s)
+            if j is not None:
+                first[j] = q
+                known[j] = True
+        present = ~numpy.isnan(prices)
+        # Row of the most recent quote of each symbol
+        last = numpy.where(present, numpy.arange(n)[:, None], 0)
+        numpy.maximum.accumulate(last, axis=0, out=last)
+        prices = prices[last, numpy.arange(m)]
+        self.known = numpy.logical_or.accumulate(present, axis=0) | known
+        self.prices = numpy.where(numpy.isnan(prices), first, prices)
+
+    @classmethod
+    def load(cls, symbols, start, end):
+        # Quotes on all quote dates from "start" to "end" (datetime.date),
+        # starting with the most recent quotes before "start".
+        symbols = sorted(symbols)
+        dates = getQuoteDates(start, end)
+        rows = getDateQuotes(symbols, start, end) if symbols else []
+        initial = getQuotes(start - datetime.timedelta(days=1), symbols)
+        return cls(dates, symbols, rows, initial)
+
+    def index(self, date):
+        # Row of the last quote date on or before "date" or -1
+        return bisect.bisect_right(self.dates, date) - 1
+
+    def asOf(self, date, symbols=None):
+        # Dictionary of the most recent quotes on or before "date"
+        i = self.index(date)
+        symbols = self.symbols if symbols is None else symbols
+        if i < 0:
+            return {s: self.initial[s] for s in symbols
+                    if s in self.columns and s in self.initial}
+        return {s: toQuote(self.prices[i, self.columns[s]].item())
+                for s in symbols
+                if s in self.columns and self.known[i, self.columns[s]]}
+
+    def quotes(self, i, symbols):
+        # Quotes of row "i" as a list, 0 for unknown symbols
+        columns = [self.columns[s] for s in symbols]
+        return [toQuote(q) if k else 0 for q, k in
+                zip(self.prices[i, columns].tolist(),
+                    self.known[i, columns].tolist())]
+
+    def slice(self, start, end):
+        # Dates and quotes from "start" to "end" inclusive
+        i = bisect.bisect_left(self.dates, start)
+        j = bisect.bisect_right(self.dates, end)
+        return (self.dates[i:j], self.prices[i:j])
+
+    def counts(self, positions):
+        # Matrix of share counts from a list of (symbol, count) per date
+        counts = numpy.zeros(self.prices.shape)
+        for i, p in enumerate(positions):
+            if p:
+                symbols, n = zip(*p)
+                counts[i, [self.columns[s] for s in symbols]] = n
+        return counts
+
+    def value(self, counts):
+        # Value of the share counts on every date.  The values of the symbols
+        # are added in column order like the sums of the dictionary code so
+        # that rounded values don't depend on NumPy.
+        value = numpy.zeros(len(self.dates))
+        for j in range(len(self.symbols)):
+            value += counts[:, j] * self.prices[:, j]
+        return value
+
+
+def toQuote(q):
+    # The NUMBER column of the quote database returns integral quotes as int.
+    return int(q) if q.is_integer() else q
@@ -2,17 +2,25 @@
 # -*- coding: utf-8 -*-
 
 import bisect
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from contextlib import closing
 import datetime
 import io
 import json
 import gzip
-import sqlite3
+import hashlib
 import os
 import re
+import sqlite3
+import tempfile
+import time
+import urllib.error
 import urllib.request
 
+from .connections import pool
+
 
 quote_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'quotes')
 quote_db = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache/quotes.db')
@@ -20,6 +28,12 @@ quote_db = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache/quot
 json_url_prefix = 'https://query1.finance.yahoo.com/v7/finance/quote?lang=en-US&region=US&corsDomain=finance.yahoo.com&fields=symbol,longName,shortName,regularMarketPrice,regularMarketChange,currency,regularMarketTime,regularMarketVolume,quantity,regularMarketDayHigh,regularMarketDayLow,regularMarketOpen,marketCap&symbols='
 json_url_suffix = '&formatted=false'
 max_json_quotes = 20
+# Number of concurrent requests, retries per request, and seconds between
+# the first retries
+max_json_requests = 4
+json_retries = 2
+json_retry_delay = 1
+json_timeout = 60
 
 quote_headers = [
     ('User-Agent', 'Mozilla/5.0 (Windows NT 10.0; WOW64; rv:53.0) Gecko/20100101 Firefox/53.0'),
@@ -56,8 +70,12 @@ def getFileQuotes(d, symbols=None):
     if idx == 0:
         return {}
     with open(os.path.join(quote_dir, names[idx - 1])) as f:
-        return dict((k, float(v)) for k, v in csv.reader(f)
-                    if not symbols or k in symbols)
+        return parseQuoteFile(f, symbols)
+
+
+def parseQuoteFile(f, symbols=None):
+    return dict((k, float(v)) for k, v in csv.reader(f)
+                if not symbols or k in symbols)
 
 
 def getFileQuoteDates(start, end):
@@ -77,7 +95,7 @@ def createRequest(url):
 
 
 def openRequest(req):
-    f = urllib.request.urlopen(req, None, 60)
+    f = urllib.request.urlopen(req, None, json_timeout)
     if f.info().get('Content-Encoding') == 'gzip':
         buf = io.BytesIO(f.read())
         f.close()
@@ -95,7 +113,7 @@ def extractJsonQuotes(f):
 
 
 def retrieveJsonQuotes(symbols):
-    quotes = []
+    batches = []
     while symbols:
         if len(symbols) == max_json_quotes + 1:
             s = symbols[:max_json_quotes-1]
@@ -106,13 +124,34 @@ def retrieveJsonQuotes(symbols):
         else:
             s = symbols
             symbols = []
-        with closing(openRequest(createRequest(
-                json_url_prefix + ','.join(s) + json_url_suffix))) as f:
-            quotes += extractJsonQuotes(f)
-    return quotes
+        batches.append(s)
+    if len(batches) <= 1:
+        results = map(retrieveJsonBatch, batches)
+    else:
+        with ThreadPoolExecutor(min(max_json_requests,
+                                    len(batches))) as executor:
+            results = list(executor.map(retrieveJsonBatch, batches))
+    return [q for r in results for q in r]
+
+
+def retrieveJsonBatch(symbols):
+    # Retries after network errors, timeouts, and server errors.
+    for i in range(json_retries + 1):
+        try:
+            with closing(openRequest(createRequest(
+                    json_url_prefix + ','.join(symbols) +
+                    json_url_suffix))) as f:
+                return extractJsonQuotes(f)
+        except OSError as e:
+            if (i == json_retries or
+                (isinstance(e, urllib.error.HTTPError) and e.code < 500 and
+                 e.code != 429)):
+                raise
+        time.sleep(json_retry_delay * 2 ** i)
 
 
 def retrieveQuotes(symbols, force=False):
+    # Returns True if quotes were stored.
     d = datetime.date.today()
     if d in getHolidays(d.year):
         return
@@ -142,20 +181,39 @@ def retrieveQuotes(symbols, force=False):
         for q in quotes:
             writer.writerow(q)
     if quotes:
-        try:
-            c = getQuoteCursor(quote_db)
+        file_entry, _ = readQuoteFile(ds)
+        with getQuoteCursor() as c:
             c.execute('DELETE FROM quotes WHERE date=?', [ds])
             c.executemany('INSERT INTO quotes(date,symbol,quote) VALUES(?,?,?)',
                           [(ds, k, v) for k, v in quotes])
+            # Track the file so that storeAllQuotes doesn't load it again.
+            c.execute('INSERT OR REPLACE INTO quote_files '
+                      '(date,mtime,size,checksum) VALUES(?,?,?,?)', file_entry)
+            increaseQuoteVersion(c)
             c.connection.commit()
-        finally:
-            c.connection.close()
+    return bool(quotes)
+
 
+def getQuoteVersion():
+    # The version changes with every change of the quotes, e.g., for caching.
+    with getQuoteCursor() as c:
+        c.execute('PRAGMA user_version')
+        return c.fetchone()[0]
 
-def getQuoteCursor(name):
-    os.makedirs(os.path.dirname(name), exist_ok=True)
-    conn = sqlite3.connect(name)
-    return conn.cursor()
+
+def increaseQuoteVersion(cursor, version=None):
+    # Within the transaction that changes the quotes
+    if version is None:
+        cursor.execute('PRAGMA user_version')
+        version = cursor.fetchone()[0]
+    cursor.execute('PRAGMA user_version={0}'.format(version + 1))
+
+
+def getQuoteCursor():
+    # Context manager for a cursor of the pooled connection to the quote
+    # database of the current thread
+    return pool.cursor(quote_db, createQuoteTable, createQuoteIndex,
+                       createQuoteFilesTable)
 
 
 def createQuoteTable(cursor):
@@ -164,29 +222,134 @@ def createQuoteTable(cursor):
                    'PRIMARY KEY (date, symbol))')
 
 
-def storeAllQuotes():
-    c = getQuoteCursor(quote_db)
+def createQuoteIndex(cursor):
+    # Symbol-major covering index so that the most recent quote of a symbol
+    # on or before a date is a single seek.
+    cursor.execute('CREATE INDEX IF NOT EXISTS quotes_symbol '
+                   'ON quotes (symbol, date, quote)')
+
+
+def createQuoteFilesTable(cursor):
+    # Quote files that have been loaded into the quotes table
+    cursor.execute('CREATE TABLE IF NOT EXISTS quote_files ('
+                   'date TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, '
+                   'checksum TEXT)')
+
+
+def readQuoteFile(ds):
+    # Returns the file entry for quote_files and the content.
+    path = os.path.join(quote_dir, ds + '.csv')
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    return ((ds, st.st_mtime_ns, st.st_size, hashlib.sha1(data).hexdigest()),
+            data)
+
+
+def storeAllQuotes(rebuild=False):
+    # Loads the quote files that are new or changed since the last call and
+    # removes the quotes of deleted files.  An empty database is always
+    # rebuilt.  Returns the earliest date with changed quotes or None.
+    quote_dates = getFileQuoteDates(datetime.date(1990, 1, 1),
+                                    datetime.date.today())
+    with getQuoteCursor() as c:
+        c.execute('SELECT date,mtime,size,checksum FROM quote_files')
+        stored = {r[0]: r[1:] for r in c.fetchall()}
+        if stored:
+            known = set(stored)
+        else:
+            # Loaded before the files were tracked
+            c.execute('SELECT DISTINCT date FROM quotes')
+            known = set(r[0] for r in c.fetchall())
+        if known and not rebuild:
+            changed = updateQuotes(c, quote_dates, stored, known)
+    if not known or rebuild:
+        rebuildQuotes(quote_dates)
+        changed = known.union(d.isoformat() for d in quote_dates)
+    if changed:
+        return datetime.datetime.strptime(min(changed), '%Y-%m-%d').date()
+    return None
+
+
+def updateQuotes(c, quote_dates, stored, known):
+    # Returns the changed dates.
+    changed = []
+    files = []
+    for d in quote_dates:
+        ds = d.isoformat()
+        st = os.stat(os.path.join(quote_dir, ds + '.csv'))
+        entry = stored.get(ds)
+        if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+            continue
+        file_entry, data = readQuoteFile(ds)
+        files.append(file_entry)
+        if entry is not None and entry[2] == file_entry[3]:
+            continue
+        quotes = parseQuoteFile(io.StringIO(data.decode()))
+        # Untracked files may have quotes, too, e.g., from an older version
+        # of retrieveQuotes.
+        c.execute('SELECT symbol,quote FROM quotes WHERE date=?', [ds])
+        if dict(c.fetchall()) == quotes:
+            continue
+        c.execute('DELETE FROM quotes WHERE date=?', [ds])
+        c.executemany('INSERT INTO quotes(date,symbol,quote) VALUES(?,?,?)',
+                      [(ds, k, v) for k, v in quotes.items()])
+        changed.append(ds)
+    removed = known.difference(d.isoformat() for d in quote_dates)
+    for ds in removed:
+        c.execute('DELETE FROM quotes WHERE date=?', [ds])
+        c.execute('DELETE FROM quote_files WHERE date=?', [ds])
+    c.executemany('INSERT OR REPLACE INTO quote_files '
+                  '(date,mtime,size,checksum) VALUES(?,?,?,?)', files)
+    if changed or removed:
+        increaseQuoteVersion(c)
+    c.connection.commit()
+    return changed + list(removed)
+
+
+def rebuildQuotes(quote_dates):
+    # Loads all quote files into a new database without journal and with the
+    # index created at the end.  That database is copied into the quote
+    # database in one transaction so that readers see either the old or the
+    # new quotes and are only blocked by the copy.  Renaming the new file
+    # over the quote database could corrupt it because connections of other
+    # processes would pick up the old WAL file.
+    dirname = os.path.dirname(quote_db)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.quotes-')
+    os.close(fd)
     try:
-        createQuoteTable(c)
-        quote_dates = getFileQuoteDates(datetime.date(1990, 1, 1),
-                                        datetime.date.today())
-        c.execute('DELETE FROM quotes')
-        for d in quote_dates:
-            ds = d.isoformat()
-            quotes = getFileQuotes(d)
-            c.executemany('INSERT INTO quotes(date,symbol,quote) '
-                          'VALUES(?,?,?)',
-                          [(ds, k, v) for k, v in quotes.items()])
-        c.connection.commit()
+        with closing(sqlite3.connect(tmp)) as conn:
+            for pragma in ['journal_mode=OFF', 'synchronous=OFF',
+                           'locking_mode=EXCLUSIVE', 'cache_size=-64000']:
+                conn.execute('PRAGMA ' + pragma)
+            c = conn.cursor()
+            createQuoteTable(c)
+            createQuoteFilesTable(c)
+            files = []
+            for d in quote_dates:
+                file_entry, data = readQuoteFile(d.isoformat())
+                files.append(file_entry)
+                c.executemany('INSERT INTO quotes(date,symbol,quote) '
+                              'VALUES(?,?,?)',
+                              [(file_entry[0], k, v) for k, v in
+                               parseQuoteFile(io.StringIO(data.decode()))
+                               .items()])
+            c.executemany('INSERT INTO quote_files '
+                          '(date,mtime,size,checksum) VALUES(?,?,?,?)', files)
+            createQuoteIndex(c)
+            # The backup replaces the version of the quote database.
+            increaseQuoteVersion(c, getQuoteVersion())
+            conn.commit()
+            with getQuoteCursor() as dst:
+                conn.backup(dst.connection)
     finally:
-        c.connection.close()
+        os.unlink(tmp)
 
 
 def getQuotes(d, symbols=None, same_day=False):
     d = d.isoformat()
-    c = getQuoteCursor(quote_db)
-    try:
-        createQuoteTable(c)
+    with getQuoteCursor() as c:
         c.execute('SELECT MAX(date) FROM quotes WHERE date<=?', [d])
         row = c.fetchone()
         if row is None:
@@ -202,54 +365,143 @@ def getQuotes(d, symbols=None, same_day=False):
             quotes = dict(c.fetchall())
             if same_day:
                 return quotes
-            symbols = [s for s in symbols if s not in quotes]
-            if symbols:
-                c.execute('SELECT quotes.symbol,quote FROM quotes JOIN '
-                          '(SELECT symbol,MAX(date) AS date FROM quotes '
-                          'WHERE date<=? AND symbol IN ({0}) '
-                          'GROUP BY symbol) AS recent '
-                          'ON quotes.symbol=recent.symbol '
-                          'AND quotes.date=recent.date'
-                          .format(','.join(['?'] * len(symbols))),
-                          [d] + symbols)
-                quotes.update(dict(c.fetchall()))
+            for s in symbols:
+                if s not in quotes:
+                    c.execute('SELECT quote FROM quotes '
+                              'WHERE symbol=? AND date<=? '
+                              'ORDER BY date DESC LIMIT 1', [s, d])
+                    row = c.fetchone()
+                    if row is not None:
+                        quotes[s] = row[0]
             return quotes
         else:
             c.execute('SELECT symbol,quote FROM quotes WHERE date=?', [d])
             return dict(c.fetchall())
-    finally:
-        c.connection.close()
+
+
+def getQuotesAsOf(requests, same_day=False):
+    # getQuotes for a sequence of (date, symbols) in a single query, e.g.,
+    # for year ends.  Returns the quotes of each request in the same order.
+    requests = list(requests)
+    results = [{} for _ in requests]
+    if not requests:
+        return results
+    op = '=' if same_day else '<='
+    with getQuoteCursor() as c:
+        # See getDayQuotes for the savepoint.
+        c.execute('SAVEPOINT asof')
+        try:
+            c.execute('CREATE TEMP TABLE asof (id INTEGER, date TEXT, '
+                      'symbol TEXT)')
+            # A NULL symbol stands for all symbols of the quote date.
+            c.executemany('INSERT INTO asof(id,date,symbol) VALUES(?,?,?)',
+                          ((i, d.isoformat(), s)
+                           for i, (d, symbols) in enumerate(requests)
+                           for s in (symbols or [None])))
+            c.execute('WITH days AS (SELECT id,symbol,'
+                      '(SELECT MAX(date) FROM quotes WHERE date<=asof.date) '
+                      'AS day FROM asof) '
+                      'SELECT id,quotes.symbol,quote FROM days '
+                      'JOIN quotes ON quotes.date=days.day '
+                      'WHERE days.symbol IS NULL '
+                      'UNION ALL '
+                      'SELECT id,symbol,(SELECT quote FROM quotes '
+                      'WHERE quotes.symbol=days.symbol AND date{0}days.day '
+                      'ORDER BY date DESC LIMIT 1) FROM days '
+                      'WHERE days.symbol IS NOT NULL'.format(op))
+            for i, symbol, quote in c:
+                if quote is not None:
+                    results[i][symbol] = quote
+        finally:
+            c.execute('ROLLBACK TO asof')
+            c.execute('RELEASE asof')
+    return results
+
+
+class QuoteContext:
+    # The quotes needed by a request.  All dates and symbols are added before
+    # the first "get" so that they are fetched with a single query.  Only
+    # the added symbols are returned.
+    def __init__(self):
+        self.needs = defaultdict(set)
+        self.quotes = None
+
+    def add(self, d, symbols):
+        self.needs[d].update(symbols)
+        self.quotes = None
+
+    def get(self, d, symbols=None):
+        if self.quotes is None:
+            # Without symbols, getQuotesAsOf would return all quotes.
+            dates = [k for k, v in self.needs.items() if v]
+            self.quotes = dict(zip(dates, getQuotesAsOf(
+                (k, self.needs[k]) for k in dates)))
+        quotes = self.quotes.get(d, {})
+        if symbols is None:
+            return dict(quotes)
+        return {s: quotes[s] for s in symbols if s in quotes}
 
 
 def getQuoteDates(start, end):
-    c = getQuoteCursor(quote_db)
-    try:
+    with getQuoteCursor() as c:
         c.execute('SELECT DISTINCT date FROM quotes WHERE date>=? AND date<=? '
                   'ORDER BY date',
                   [start.isoformat(), end.isoformat()])
         return [datetime.datetime.strptime(x[0], '%Y-%m-%d').date()
                 for x in c.fetchall()]
-    finally:
-        c.connection.close()
 
 
 def getDateQuotes(symbols, start, end):
-    c = getQuoteCursor(quote_db)
-    try:
-        createQuoteTable(c)
+    return list(iterDateQuotes(symbols, start, end))
+
+
+def iterDateQuotes(symbols, start, end):
+    # Like getDateQuotes but without loading all rows
+    with getQuoteCursor() as c:
         c.execute('SELECT date,symbol,quote FROM quotes WHERE date>=? AND date<=? '
                   'AND symbol IN ({0}) ORDER BY date,symbol'
                   .format(','.join(['?'] * len(symbols))),
                   [start.isoformat(), end.isoformat()] + symbols)
-        return c.fetchall()
-    finally:
-        c.connection.close()
+        yield from c
+
+
+def getDayQuotes(days):
+    # Quotes of the given symbols on the given days without falling back to
+    # earlier days.  "days" is a sequence of (date, symbols).  Returns
+    # (date, symbol, quote) ordered by date and symbol.
+    with getQuoteCursor() as c:
+        # The temporary table is removed by rolling back to a savepoint
+        # because the connection is reused.  Unlike a rollback, that keeps
+        # the transaction of an enclosing cursor.
+        c.execute('SAVEPOINT wanted')
+        try:
+            c.execute('CREATE TEMP TABLE wanted (date TEXT, symbol TEXT)')
+            c.executemany('INSERT INTO wanted(date,symbol) VALUES(?,?)',
+                          ((d.isoformat(), s) for d, symbols in days
+                           for s in symbols))
+            c.execute('SELECT quotes.date,quotes.symbol,quote FROM wanted '
+                      'JOIN quotes ON quotes.date=wanted.date '
+                      'AND quotes.symbol=wanted.symbol '
+                      'ORDER BY quotes.date,quotes.symbol')
+            return c.fetchall()
+        finally:
+            c.execute('ROLLBACK TO wanted')
+            c.execute('RELEASE wanted')
+
+
+def setQuoteUrl(url_prefix, url_suffix=''):
+    # The symbols are inserted between prefix and suffix, e.g., to use a
+    # local server.
+    global json_url_prefix, json_url_suffix
+    json_url_prefix = url_prefix
+    json_url_suffix = url_suffix
 
 
 def setQuotePaths(dir_path, db_path):
     global quote_dir, quote_db
     quote_dir = dir_path
     quote_db = db_path
+    pool.reset()
 
 
 def getEaster(year):
@@ -1,21 +1,81 @@
 # -*- coding: utf-8 -*-
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import copy
 import datetime
 from flask import Blueprint, jsonify, request, Response
+from functools import wraps
+import hashlib
 from itertools import groupby
 import json
 import os
 import re
 import sys
+import threading
 import traceback
 
-from .portfolio import Portfolio, Transaction, getOptionParameters, data_dir, cache_dir
-from .stockquotes import getQuotes, retrieveQuotes, storeAllQuotes, getDateQuotes
+from . import jobs
+from .portfolio import ForwardReplay, Portfolio, Transaction, getOptionPair, getOptionParameters, replayAccounts, data_dir, cache_dir
+from .stockquotes import QuoteContext, getQuotesAsOf, getQuoteVersion, retrieveQuotes, storeAllQuotes, iterDateQuotes
 
 bp = Blueprint('views', __name__)
 
+# Number of cached responses
+response_cache_size = 32
+response_cache = OrderedDict()
+response_cache_lock = threading.Lock()
+
+
+def cached_response(f):
+    # For responses that only depend on the parameters, the date, the data
+    # files, and the quotes.  The ETag identifies those inputs so that
+    # matching requests are answered without computing the response.
+    @wraps(f)
+    def wrapper():
+        etag = response_etag()
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        with response_cache_lock:
+            data = response_cache.get(etag)
+            if data is not None:
+                response_cache.move_to_end(etag)
+        if data is not None:
+            response = Response(data, mimetype='application/json')
+        else:
+            response = f()
+            data = response.get_data()
+            # Errors have "error" as the only key.
+            if (response.status_code == 200 and
+                not re.match(rb'\{\s*"error":', data)):
+                with response_cache_lock:
+                    response_cache[etag] = data
+                    while len(response_cache) > response_cache_size:
+                        response_cache.popitem(last=False)
+        response.set_etag(etag)
+        return response
+    return wrapper
+
+
+def response_etag():
+    h = hashlib.sha1()
+    h.update('{0}|{1}|{2}|{3}'.format(
+        request.path, sorted(request.args.items(multi=True)),
+        datetime.date.today().isoformat(), getQuoteVersion()).encode())
+    # The account files, the transfers, and the dividends of the indexes
+    for path, names in [(data_dir, None), (cache_dir, '-dividend')]:
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except FileNotFoundError:
+            continue
+        for e in entries:
+            if e.is_file() and (names is None or e.name.endswith(names)):
+                st = e.stat()
+                h.update('|{0}|{1}|{2}'.format(e.name, st.st_mtime_ns,
+                                               st.st_size).encode())
+    return h.hexdigest()
+
 
 @bp.route('/get-accounts')
 def get_accounts():
@@ -33,6 +93,7 @@ def get_accounts():
 
 
 @bp.route('/get-report')
+@cached_response
 def get_report():
     account = request.args.get('account', 'all')
     date = request.args.get('date')
@@ -63,8 +124,9 @@ def get_report():
         for p in portfolios:
             share_diff = defaultdict(float)
             share_diffs.append(share_diff)
-            for t in p.transactions:
-                if t.date <= prev_year_end or t.is_cash_like():
+            # The transactions of the last fill, a TransactionTimeline
+            for t in p.transactions.range(prev_year_end):
+                if t.is_cash_like():
                     continue
                 if t.type == 'x' and (not t.name2 or t.name2 == t.name):
                     year_quote_splits[t.name] = 1 / (1 + t.amount1)
@@ -87,9 +149,12 @@ def get_report():
         else:
             account_portfolios = {p.account: p for p in portfolios}
         symbols = set([s for p in portfolios for s in p.getCurrentSymbols()])
-        data['quotes'] = getQuotes(Transaction.toDate(d), symbols)
-        old_quotes = getQuotes(Transaction.toDate(d - 1), symbols)
-        year_quotes = getQuotes(Transaction.toDate(prev_year_end), symbols)
+        context = QuoteContext()
+        for day in [d, d - 1, prev_year_end]:
+            context.add(Transaction.toDate(day), symbols)
+        data['quotes'] = context.get(Transaction.toDate(d), symbols)
+        old_quotes = context.get(Transaction.toDate(d - 1), symbols)
+        year_quotes = context.get(Transaction.toDate(prev_year_end), symbols)
         for k, v in quote_splits.items():
             try:
                 old_quotes[k] *= v
@@ -124,6 +189,7 @@ def get_report():
 
 
 @bp.route('/get-taxes')
+@cached_response
 def get_taxes():
     try:
         data = get_taxes2(request.args.get('account'),
@@ -147,11 +213,15 @@ def get_taxes2(account, year=None, skip=None):
     data = portfolio.toDict(year=year)
     data['year'] = year
     data['account'] = account
-    data['quotes'] = getQuotes(datetime.date(int(year), 12, 31))
+    end = datetime.date(int(year), 12, 31)
+    context = QuoteContext()
+    context.add(end, lot_symbols(data))
+    data['quotes'] = context.get(end)
     return data
 
 
 @bp.route('/get-annual')
+@cached_response
 def get_annual():
     try:
         data = get_annual2(request.args.get('account', 'all'),
@@ -173,45 +243,39 @@ def get_annual2(account, year=None, skip=None):
     d = Transaction.parseDate(date)
     account_transfers = Portfolio.get_transfers(data_dir)
     files = Portfolio.get_files(data_dir, account, account_transfers, d)
-    # Still need to implement "combined" (year loop outside file loop?)
+    replays = {}
     for f in files:
-        trans = Transaction.readTransactions(os.path.join(data_dir, f), d, skip=skip)
+        trans = Transaction.readTimeline(os.path.join(data_dir, f), d, skip=skip)
         accounts = Portfolio.readTransfers(d, f, account_transfers, skip=skip)
-        if not trans and not accounts:
-            continue
+        if trans or accounts:
+            years = set(k for k, _ in trans.years())
+            replays[f] = (years, ForwardReplay(trans, accounts))
+    if account == 'combined':
+        # The years of all accounts with their combined portfolios
+        groups = {account: list(replays.values())}
+    else:
+        groups = {f: [r] for f, r in replays.items()}
+    for f, group in groups.items():
         years = []
-        for k, g in groupby(trans, key=lambda x: Transaction.toYear(x.date)):
+        deposits = []
+        for k in sorted(set(k for y, _ in group for k in y)):
             start = Transaction.fromYear(k)
             end = min(d, Transaction.fromYearEnd(k))
-            p = Portfolio(end)
-            start2 = 0
-            for (d2, _, trans2) in accounts:
-                end2 = min(end, d2)
-                # print()
-                # print(f, k, start, end, start2, end2)
-                # print(p.toDict())
-                p.fillLots([t for t in trans
-                            if t.date > start2 and t.date <= end2])
-                start2 = end2
-                p2 = Portfolio(end2)
-                p2.fillLots([t for t in trans2 if t.date <= end2])
-                p = Portfolio.combine([p, p2])
-            # print()
-            # print(f, k, start, end, start2)
-            # print(p.toDict())
-            # print([t for t in trans if t.date > start2])
-            p.fillLots([t for t in trans
-                        if t.date > start2 and t.date <= end])
+            p = Portfolio.combine([r.portfolio(end) for y, r in group
+                                   if min(y, default=k) <= k])
             year = p.toDict()
+            # The replay continues with the same portfolio.
+            deposits = year['deposits'] = list(p.deposits)
             year['start'] = start
             year['end'] = end
             year['year'] = k
             symbols[k].update(p.lots.keys())
             years.append(year)
-        data['accounts'][f] = {'years': years, 'deposits': p.deposits}
-    quotes = {}
-    for k, v in symbols.items():
-        quotes[k] = getQuotes(Transaction.toDate(min(d, Transaction.fromYearEnd(k))), v)
+        data['accounts'][f] = {'years': years, 'deposits': deposits}
+    keys = list(symbols)
+    quotes = dict(zip(keys, getQuotesAsOf(
+        (Transaction.toDate(min(d, Transaction.fromYearEnd(k))), symbols[k])
+        for k in keys)))
     data['quotes'] = quotes
     min_quote = min(quotes.keys())
     for k, v in data['accounts'].items():
@@ -227,7 +291,14 @@ def get_annual2(account, year=None, skip=None):
     return data
 
 
+def lot_symbols(data):
+    # The symbols of the open lots in a response including the underlying
+    # stocks of options.  Completed and assigned lots have their own prices.
+    return set(s for lt in data['lots'] for s in getOptionPair(lt['symbol']))
+
+
 @bp.route('/get-spy')
+@cached_response
 def get_spy():
     end = request.args.get('end', datetime.date.today().isoformat())
     spy = set(['SPY'])
@@ -242,14 +313,17 @@ def get_spy():
         year = {}
         year['end'] = end
         year['year'] = y
-        year['quotes'] = getQuotes(Transaction.toDate(end), spy)
         years.append(year)
+    quotes = getQuotesAsOf((Transaction.toDate(x['end']), spy) for x in years)
+    for year, q in zip(years, quotes):
+        year['quotes'] = q
     data = {'years': years,
             'dividends': [(t.date, t.amount1) for t in dividends]}
     return jsonify(data)
 
 
 @bp.route('/get-options')
+@cached_response
 def get_options():
     account = request.args.get('account')
     date = request.args.get('date', datetime.date.today().isoformat())
@@ -269,9 +343,14 @@ def get_options():
                        for lt in portfolio.assigned_lots)
         historical = {k: set(x[1] for x in g)
                       for k, g in groupby(pairs, key=lambda x: x[0])}
-        data['quotes'] = getQuotes(Transaction.toDate(d))
+        symbols = lot_symbols(data)
+        context = QuoteContext()
+        context.add(Transaction.toDate(d), symbols)
+        for k, g in historical.items():
+            context.add(Transaction.toDate(k), g)
+        data['quotes'] = context.get(Transaction.toDate(d), symbols)
         hq = {Transaction.toDate(k).isoformat():
-              getQuotes(Transaction.toDate(k), g)
+              context.get(Transaction.toDate(k), g)
               for k, g in historical.items()}
         data['historical_quotes'] = hq
     except:
@@ -285,11 +364,20 @@ def get_history():
     start = request.args.get('start', '1970-01-01')
     end = request.args.get('end', datetime.date.today().isoformat())
     include_positions = request.args.get('positions', '') == 'true'
+    symbol = request.args.get('symbol')
+    fmt = request.args.get('format')
     try:
         start = Transaction.parseDate(start)
         end = Transaction.parseDate(end)
-        data = Portfolio.getHistory(account, start, end,
-                                    include_positions=include_positions)
+        if symbol:
+            data = Portfolio.getSymbolHistory(account, symbol, start, end)
+        elif fmt in stream_formats:
+            # The history is updated before the response starts.
+            return stream_json(Portfolio.iterHistory(
+                account, start, end, include_positions=include_positions), fmt)
+        else:
+            data = Portfolio.getHistory(account, start, end,
+                                        include_positions=include_positions)
     except:
         data = format_exception()
     return jsonify(data)
@@ -298,28 +386,62 @@ def get_history():
 @bp.route('/clear-history')
 def clear_history():
     account = request.args.get('account')
+    job = jobs.runner.submit('clear-history', clear_history_job, account)
+    return job_response(job)
+
+
+def clear_history_job(account):
     account_transfers = Portfolio.get_transfers(data_dir)
     Portfolio.clearHistory(account, account_transfers)
-    return Response('ok\n', mimetype='text/plain')
 
 
 @bp.route('/retrieve-quotes')
 def retrieve_quotes():
+    force = request.args.get('force') == 'true'
+    job = jobs.runner.submit('retrieve-quotes', retrieve_quotes_job, force)
+    return job_response(job)
+
+
+def retrieve_quotes_job(force):
     date = Transaction.parseDate(datetime.date.today().isoformat())
     account_transfers = Portfolio.get_transfers(data_dir)
     files = Portfolio.get_files(data_dir, 'combined', account_transfers)
     portfolios, _ = init_portfolios(date, files, account_transfers)
     portfolio = Portfolio.combine(portfolios)
-    force = request.args.get('force') == 'true'
-    retrieveQuotes(portfolio.getCurrentSymbols(), force=force)
-    return Response('ok\n', mimetype='text/plain')
+    if retrieveQuotes(portfolio.getCurrentSymbols(), force=force):
+        # Precompute the history so that the first request of the day is
+        # fast.
+        for f in Portfolio.get_files(data_dir, 'all', account_transfers, date):
+            jobs.runner.submit('update-history', update_history_job, f)
+
+
+def update_history_job(account):
+    Portfolio.updateHistories(account, Portfolio.get_transfers(data_dir))
 
 
 @bp.route('/update-quotes')
 def update_quotes():
-    Portfolio.clearHistory('all')
-    storeAllQuotes()
-    return Response('ok\n', mimetype='text/plain')
+    rebuild = request.args.get('rebuild') == 'true'
+    job = jobs.runner.submit('update-quotes', update_quotes_job, rebuild)
+    return job_response(job)
+
+
+def update_quotes_job(rebuild):
+    # Only the history from the earliest changed quotes needs to be rebuilt.
+    since = storeAllQuotes(rebuild=rebuild)
+    if since is not None:
+        Portfolio.clearHistory('all', since=Transaction.fromDate(since))
+
+
+def job_response(job):
+    # The status of a submitted job so that its progress can be followed
+    # with /get-jobs.  Jobs executed inline have finished already.
+    return jsonify(job.toDict()), 500 if job.state == 'failed' else 200
+
+
+@bp.route('/get-jobs')
+def get_jobs():
+    return jsonify(jobs.runner.status())
 
 
 @bp.route('/get-date-quotes')
@@ -330,10 +452,45 @@ def get_date_quotes():
     end = request.args.get('end', datetime.date.today().isoformat())
     start = datetime.datetime.strptime(start, '%Y-%m-%d').date()
     end = datetime.datetime.strptime(end, '%Y-%m-%d').date()
-    quotes = getDateQuotes(symbols, start, end)
-    data = [{'date': k, 'quotes': [{'symbol': x[1], 'close': x[2]} for x in g]}
-            for k, g in groupby(quotes, key=lambda x: x[0])]
-    return jsonify({'data': data})
+    quotes = iterDateQuotes(symbols, start, end)
+    data = ({'date': k, 'quotes': [{'symbol': x[1], 'close': x[2]} for x in g]}
+            for k, g in groupby(quotes, key=lambda x: x[0]))
+    fmt = request.args.get('format')
+    if fmt in stream_formats:
+        return stream_json(data, fmt, '{"data":[', ']}')
+    return jsonify({'data': list(data)})
+
+
+# "ndjson" emits a JSON object per line and "stream" the same JSON as without
+# streaming.
+stream_formats = ['ndjson', 'stream']
+# Number of rows per chunk of a streamed response
+stream_chunk_rows = 100
+
+
+def stream_json(rows, fmt, prefix='[', suffix=']'):
+    # Encodes the rows while the response is sent.  The encoding matches
+    # jsonify.
+    def generate():
+        chunk = [] if fmt == 'ndjson' else [prefix]
+        separator = ''
+        for r in rows:
+            if fmt == 'ndjson':
+                chunk.append(json.dumps(r, sort_keys=True,
+                                        separators=(',', ':')) + '\n')
+            else:
+                chunk.append(separator + json.dumps(r, sort_keys=True,
+                                                    separators=(',', ':')))
+                separator = ','
+            if len(chunk) >= stream_chunk_rows:
+                yield ''.join(chunk)
+                chunk = []
+        if fmt != 'ndjson':
+            chunk.append(suffix + '\n')
+        yield ''.join(chunk)
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(generate(), mimetype=mimetype)
 
 
 def init_portfolios(date, files, account_transfers, skip=None):
@@ -342,27 +499,12 @@ def init_portfolios(date, files, account_transfers, skip=None):
     # be avoided.
     portfolios = []
     error = None
-    for f in files:
-        trans = Transaction.readTransactions(os.path.join(data_dir, f), date,
-                                             skip=skip)
-        bad = Transaction.checkTransactions(trans)
+    results = replayAccounts(date, files, account_transfers, skip=skip)
+    for f, (portfolio, bad) in zip(files, results):
         if bad:
             error = {'account': f, 'transaction': bad}
-        accounts = Portfolio.readTransfers(date, f, account_transfers,
-                                           skip=skip)
-        if not trans and not accounts:
-            continue
-        portfolio = Portfolio(date, f)
-        start = 0
-        for end, _, trans2 in accounts:
-            portfolio.fillLots([t for t in trans
-                                if t.date > start and t.date <= end])
-            start = end
-            p = Portfolio(end)
-            p.fillLots(trans2)
-            portfolio = Portfolio.combine([portfolio, p])
-        portfolio.fillLots([t for t in trans if t.date > start])
-        portfolios.append(portfolio)
+        if portfolio is not None:
+            portfolios.append(portfolio)
     return (portfolios, error)
 
 
@@ -6,4 +6,4 @@ from portfolioapi import stockquotes
 
 def test_aa_store_all_quotes(client):
     response = client.get('/update-quotes')
-    assert response.data == b'ok\n'
+    assert response.get_json()['state'] == 'done'
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from portfolioapi.connections import ConnectionPool
+
+
+def test_connection_pool(tmp_path):
+    pool = ConnectionPool()
+    path = os.path.join(tmp_path, 'db', 'test.db')
+    created = []
+
+    def createTable(c):
+        created.append(c)
+        c.execute('CREATE TABLE IF NOT EXISTS t (x INTEGER)')
+
+    with pool.cursor(path, createTable) as c:
+        conn = c.connection
+        assert c.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        c.execute('INSERT INTO t VALUES(1)')
+        with pool.cursor(path) as c2:
+            assert c2.connection is conn
+        # Not rolled back by the inner cursor
+        assert conn.in_transaction
+    # Uncommitted changes are discarded.
+    with pool.cursor(path, createTable) as c:
+        assert c.connection is conn
+        assert c.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+    assert len(created) == 1
+    # Threads use their own connections.
+    other = []
+
+    def run():
+        with pool.cursor(path) as c:
+            other.append(c.connection)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    assert other[0] is not conn
+    # A replaced file is reopened.
+    os.rename(path, path + '.old')
+    with pool.cursor(path, createTable) as c:
+        assert c.connection is not conn
+        conn = c.connection
+    assert len(created) == 2
+    pool.reset()
+    with pool.cursor(path) as c:
+        assert c.connection is not conn
@@ -11,3 +11,54 @@ def test_get_annual(client):
         expected = json.load(f)
     print(response.data)
     assert json.loads(response.data) == expected
+
+
+def test_get_annual_combined(client):
+    # account1 was transferred into account2, the only remaining account.
+    response = client.get('/get-annual?account=combined&year=2019&skip=options')
+    data = json.loads(response.data)
+    with open(os.path.join(os.path.dirname(__file__),
+                           'get_annual.json')) as f:
+        expected = json.load(f)
+    assert list(data['accounts']) == ['combined']
+    assert data['accounts']['combined'] == expected['accounts']['account2']
+    assert data['quotes'] == expected['quotes']
+
+
+def test_forward_replay(client):
+    from portfolioapi import portfolio
+    Transaction, Portfolio = portfolio.Transaction, portfolio.Portfolio
+
+    def state(p):
+        # Portfolio.replay also records the account of the lots.  Unlike
+        # first_deposit, its values of the year aren't changed by combining
+        # with the portfolio transferred in an earlier year.
+        data = p.toDict(all=True)
+        for k in ['lots', 'completed_lots', 'assigned_lots']:
+            for lt in data[k]:
+                lt.pop('account', None)
+        return ({k: getattr(p, k) for k in
+                 ['cash', 'cash_diff', 'cash_like', 'cash_like_diff',
+                  'equity_diff', 'new_deposits', 'total_deposits',
+                  'realized_long', 'realized_short', 'purchase_total',
+                  'interest_total']},
+                [(it.name, it.amount) for it in p.interest],
+                data, list(p.deposits))
+
+    transfers = Portfolio.get_transfers(portfolio.data_dir)
+    trans = {f: Transaction.readTimeline(os.path.join(portfolio.data_dir, f))
+             for f in ['account1', 'account2']}
+    transfer = Transaction.parseDate('2013-01-01')
+    # Transaction dates, where the daily differences matter, and year ends
+    dates = set(t.date for f in trans for t in trans[f])
+    dates.update(Transaction.fromYearEnd(y) for y in range(1998, 2020))
+    dates = sorted(dates)
+    replay = portfolio.ForwardReplay(
+        trans['account2'],
+        Portfolio.readTransfers(dates[-1], 'account2', transfers))
+    for d in dates:
+        expected = [Portfolio.replay(d, 'account2', transfers)[0]]
+        if d < transfer:
+            expected.append(Portfolio.replay(d, 'account1', transfers)[0])
+        expected = Portfolio.combine([p for p in expected if p is not None])
+        assert state(replay.portfolio(d)) == state(expected), d
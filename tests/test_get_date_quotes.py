@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+
+def test_get_date_quotes(client):
+    url = '/get-date-quotes?symbols=CRM,OTEX&start=2012-01-01&end=2020-06-30'
+    response = client.get(url)
+    expected = json.loads(response.data)
+    assert [d['date'] for d in expected['data']] == ['2012-12-31',
+                                                     '2020-06-29']
+    assert expected['data'][0]['quotes'] == [{'symbol': 'OTEX',
+                                              'close': 55.888}]
+    assert client.get(url + '&format=stream').data == response.data
+    response = client.get(url + '&format=ndjson')
+    assert ([json.loads(x) for x in response.data.splitlines()] ==
+            expected['data'])
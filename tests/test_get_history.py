@@ -1,15 +1,170 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import json
+import mock
 import os
+import shutil
 
 
 def test_get_history(client):
     response = client.get('/clear-history?account=account2')
-    assert response.data == b'ok\n'
+    assert response.get_json()['state'] == 'done'
     response = client.get('/get-history?account=account2&end=2020-06-29&positions=true')
     with open(os.path.join(os.path.dirname(__file__),
                            'get_history.json')) as f:
         expected = json.load(f)
     print(response.data)
     assert json.loads(response.data) == expected
+
+
+def test_get_symbol_history(client):
+    response = client.get('/get-history?account=account2&end=2020-06-29&positions=true')
+    expected = [{'date': h['date'], 'shares': p[1], 'quote': p[2],
+                 'value': round(p[1] * p[2], 2)}
+                for h in json.loads(response.data)
+                for p in h['positions'] if p[0] == 'OTEX']
+    assert expected
+    response = client.get('/get-history?account=account2&end=2020-06-29&symbol=OTEX')
+    assert json.loads(response.data) == expected
+
+
+def test_get_history_stream(client):
+    url = '/get-history?account=account2&end=2020-06-29&positions=true'
+    expected = client.get(url).data
+    response = client.get(url + '&format=stream')
+    assert response.is_streamed
+    assert response.data == expected
+    response = client.get(url + '&format=ndjson')
+    assert response.mimetype == 'application/x-ndjson'
+    assert ([json.loads(x) for x in response.data.splitlines()] ==
+            json.loads(expected))
+
+
+def test_merge_histories(tmp_path):
+    from portfolioapi import portfolio
+    histories = {
+        'a': [(100, 1010, 1000, 1000, [('AAA', 1, 10)]),
+              (101, 1021, 1000, 1000, [('AAA', 1, 11), ('CCC', 2, 5)]),
+              (103, 1012, 1000, 1000, [('CCC', 2, 6)])],
+        'b': [(101, 2070.5, 2000, 2000, [('BBB', 3, 20), ('CCC', 1, 5.5)]),
+              (102, 2063, 2000, 2000, [('BBB', 3, 21)]),
+              (104, 2066, 2000, 2000, [('BBB', 3, 22)])]}
+    old_cache_dir = portfolio.cache_dir
+    portfolio.cache_dir = str(tmp_path)
+    try:
+        for a, rows in histories.items():
+            with portfolio.getCursor(os.path.join(tmp_path, a + '.db'),
+                                     portfolio.createPositionsTable,
+                                     portfolio.createHoldingsTable) as c:
+                c.executemany('INSERT INTO positions VALUES(?,?,?,?)',
+                              [r[:4] for r in rows])
+                c.executemany('INSERT INTO holdings VALUES(?,?,?,?)',
+                              [(r[0],) + p for r in rows for p in r[4]])
+                c.connection.commit()
+        date = lambda d: portfolio.Transaction.toDate(d).isoformat()
+        # The days of "b" after the end date are left out.  The last quote of
+        # a symbol held in both accounts is used.
+        merged = list(portfolio.mergeHistories([(103, 'a'), (103, 'b')], 100,
+                                               True))
+        assert merged == [
+            {'date': date(100), 'equity': 1010, 'cash': 1000,
+             'deposits': 1000, 'positions': [['AAA', 1, 10]]},
+            {'date': date(101), 'equity': 3091.5, 'cash': 3000,
+             'deposits': 3000,
+             'positions': [['AAA', 1, 11], ['BBB', 3, 20], ['CCC', 3, 5.5]]},
+            {'date': date(102), 'equity': 2063, 'cash': 2000,
+             'deposits': 2000, 'positions': [['BBB', 3, 21]]},
+            {'date': date(103), 'equity': 1012, 'cash': 1000,
+             'deposits': 1000, 'positions': [['CCC', 2, 6]]}]
+        merged = list(portfolio.mergeHistories([(104, 'a'), (104, 'b')], 101,
+                                               False))
+        assert ([(m['date'], m['equity']) for m in merged] ==
+                [(date(101), 3091.5), (date(102), 2063), (date(103), 1012),
+                 (date(104), 2066)])
+        assert 'positions' not in merged[0]
+    finally:
+        portfolio.cache_dir = old_cache_dir
+
+
+def test_resume_history(tmp_path):
+    from portfolioapi import portfolio, stockquotes
+    Portfolio = portfolio.Portfolio
+    data = os.path.join(os.path.dirname(__file__), 'data')
+    data_dir = os.path.join(tmp_path, 'data')
+    os.makedirs(data_dir)
+    for f in ['account1', 'account2', 'transfers']:
+        shutil.copy(os.path.join(data, f), data_dir)
+    # Quotes at quarter ends and on the days of some transactions
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    days = set(datetime.date(y, m, 1) - datetime.timedelta(days=1)
+               for y in range(1999, 2021) for m in [1, 4, 7, 10])
+    days.update(datetime.date.fromisoformat(d)
+                for d in ['1998-12-21', '2010-01-04', '2013-01-02'])
+    symbols = ['QQQ', 'QQQQ', 'MVL', 'DIS', 'GOOG', 'GOOGL', 'PFF', 'NFLX',
+               'OTEX', 'MA', 'CRM']
+    for i, d in enumerate(sorted(days)):
+        with open(os.path.join(quote_dir, d.isoformat() + '.csv'), 'w') as f:
+            f.write(''.join('{0},{1}\n'.format(s, 10 + i + j)
+                            for j, s in enumerate(symbols)))
+    # No quotes of the holdings on the first day after an update
+    with open(os.path.join(quote_dir, '2010-01-05.csv'), 'w') as f:
+        f.write('SPY,100\n')
+    old_data_paths = (portfolio.data_dir, portfolio.cache_dir)
+    old_quote_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    cache_dir = os.path.join(tmp_path, 'cache')
+    stockquotes.setQuotePaths(quote_dir, os.path.join(cache_dir, 'quotes.db'))
+    portfolio.setDataPaths(data_dir, cache_dir)
+
+    def loadHistoryState(cursor, date, digest):
+        state = load(cursor, date, digest)
+        loaded.append(state is not None)
+        return state
+
+    def history(end):
+        return Portfolio.getHistory(
+            'account2', end=portfolio.Transaction.parseDate(end),
+            include_positions=True)
+
+    load = portfolio.loadHistoryState
+    try:
+        stockquotes.storeAllQuotes()
+        transfers = Portfolio.get_transfers(data_dir)
+        expected = history('2020-06-30')
+        for edit in [False, True]:
+            Portfolio.clearHistory('account2', transfers)
+            loaded = []
+            with mock.patch.object(portfolio, 'loadHistoryState',
+                                   side_effect=loadHistoryState):
+                # The first update ends on the day of the deposit.
+                for end in ['1998-12-21', '2005-12-31', '2010-01-04']:
+                    history(end)
+                assert loaded == [True, True]
+                if edit:
+                    # Edit a transaction before the last update.
+                    with open(os.path.join(data_dir, 'account2')) as f:
+                        lines = f.read()
+                    with open(os.path.join(data_dir, 'account2'), 'w') as f:
+                        f.write(lines.replace('|GOOG|50|', '|GOOG|60|'))
+                updated = history('2020-06-30')
+                # The quotes of the previous update carry over the gap.
+                gap = [h for h in updated if h['date'] == '2010-01-05'][0]
+                assert gap['positions']
+                assert all(p[2] for p in gap['positions'])
+                # Without the edit, the update continues from the stored
+                # portfolio.  Otherwise, it starts over.
+                assert loaded[-1] is not edit
+            if not edit:
+                assert updated == expected
+        Portfolio.clearHistory('account2', transfers)
+        expected2 = history('2020-06-30')
+        assert expected2 != expected
+        # Only the days before the edit keep the previous positions.
+        assert ([h for h in updated if h['date'] > '2010-01-04'] ==
+                [h for h in expected2 if h['date'] > '2010-01-04'])
+        assert ([h for h in updated if h['date'] <= '2010-01-04'] ==
+                [h for h in expected if h['date'] <= '2010-01-04'])
+    finally:
+        stockquotes.setQuotePaths(*old_quote_paths)
+        portfolio.setDataPaths(*old_data_paths)
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 
+import datetime
 import json
+import mock
 import os
+import shutil
 
 
 def test_get_report(client):
@@ -11,3 +14,90 @@ def test_get_report(client):
         expected = json.load(f)
     print(response.data)
     assert json.loads(response.data) == expected
+
+
+def test_get_report_parallel(client):
+    from portfolioapi import portfolio, views
+    url = '/get-report?account=all&date=2012-06-29'
+    expected = client.get(url).data
+    assert b'account1' in expected and b'account2' in expected
+    views.response_cache.clear()
+    portfolio.setReplayProcesses(2, 0)
+    try:
+        assert (portfolio.getReplayExecutor(['account1', 'account2'], [])
+                is not None)
+        assert client.get(url).data == expected
+    finally:
+        portfolio.setReplayProcesses(0)
+
+
+def test_get_report_checkpoints(client, tmp_path):
+    from portfolioapi import portfolio, views
+    Transaction = portfolio.Transaction
+    data = os.path.join(os.path.dirname(__file__), 'data')
+    data_dir = os.path.join(tmp_path, 'data')
+    cache_dir = os.path.join(tmp_path, 'cache')
+    os.makedirs(data_dir)
+    os.makedirs(cache_dir)
+    for f in ['account1', 'account2', 'transfers']:
+        shutil.copy(os.path.join(data, f), data_dir)
+    for f in ['spy-dividend', 'qqq-dividend']:
+        shutil.copy(os.path.join(data, 'cache', f), cache_dir)
+    old_paths = (portfolio.data_dir, portfolio.cache_dir)
+    portfolio.setDataPaths(data_dir, cache_dir)
+    views.data_dir, views.cache_dir = data_dir, cache_dir
+    loaded = []
+    load = portfolio.Checkpoints.load
+
+    def loadCheckpoint(self):
+        checkpoint = load(self)
+        loaded.append(checkpoint and Transaction.toDate(checkpoint[0]))
+        return checkpoint
+
+    def report(url, cold=False):
+        views.response_cache.clear()
+        portfolio.transaction_cache.clear()
+        if cold:
+            # Without the cache databases of the accounts
+            portfolio.pool.reset()
+            for f in os.listdir(cache_dir):
+                if f.endswith(('.db', '.db-wal', '.db-shm')):
+                    os.remove(os.path.join(cache_dir, f))
+        return json.loads(client.get(url).data)
+
+    def edit(account, old, new):
+        with open(os.path.join(data_dir, account)) as f:
+            lines = f.read()
+        with open(os.path.join(data_dir, account), 'w') as f:
+            f.write(lines.replace(old, new))
+
+    # The portfolio date doesn't change the checkpoints, including at year
+    # ends and on the transfer date.
+    urls = ['/get-report?account=account2&date=' + d
+            for d in ['2020-06-29', '2019-12-31', '2013-01-01', '2012-12-31']]
+    try:
+        with mock.patch.object(portfolio.Checkpoints, 'load',
+                               loadCheckpoint):
+            expected = [report(url, cold=True) for url in urls]
+            # The first pass continues from the checkpoints of the last cold
+            # replay and adds the later ones.
+            for _ in range(2):
+                for url, data in zip(urls, expected):
+                    assert report(url) == data
+            assert loaded[-4:] == [datetime.date(y, 12, 31)
+                                   for y in [2019, 2018, 2012, 2011]]
+            # Edits before a checkpoint invalidate it.  The checkpoints of
+            # later years depend on the transferred account, too.
+            for account, old, new, valid in [
+                    ('account1', '|OTEX|100|', '|OTEX|120|', 2012),
+                    ('account2', '|GOOG|50|', '|GOOG|60|', 2007)]:
+                edit(account, old, new)
+                data = report(urls[0])
+                assert loaded[-1] == datetime.date(valid, 12, 31)
+                assert data != expected[0]
+                assert data == report(urls[0], cold=True)
+                expected[0] = data
+    finally:
+        portfolio.setDataPaths(*old_paths)
+        views.data_dir, views.cache_dir = old_paths
+        views.response_cache.clear()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import threading
+
+from portfolioapi import jobs
+
+
+def test_job_runner(caplog):
+    runner = jobs.JobRunner()
+    started = threading.Event()
+    release = threading.Event()
+    done = []
+
+    def block():
+        started.set()
+        release.wait(10)
+
+    def fail():
+        raise ValueError('bad')
+
+    jobs.job_workers, workers = 1, jobs.job_workers
+    try:
+        runner.submit('block', block)
+        assert started.wait(10)
+        job = runner.submit('append', done.append, 1)
+        # Identical queued jobs are only executed once.
+        assert runner.submit('append', done.append, 1) is job
+        runner.submit('fail', fail)
+        assert [j['state'] for j in runner.status()] == ['running', 'queued',
+                                                         'queued']
+        release.set()
+        last = runner.submit('append', done.append, 2)
+        assert last.wait(10)
+    finally:
+        jobs.job_workers = workers
+        release.set()
+    assert done == [1, 2]
+    status = runner.status()
+    assert [j['state'] for j in status] == ['done', 'done', 'failed', 'done']
+    assert status[2]['error'] == 'ValueError: bad'
+    # Failures are logged with the traceback.
+    assert [r.exc_info[0] for r in caplog.records
+            if r.name == 'portfolioapi.jobs'] == [ValueError]
+
+
+def test_get_jobs(client):
+    response = client.get('/clear-history?account=account1')
+    job = response.get_json()
+    assert response.status_code == 200 and job['state'] == 'done'
+    status = client.get('/get-jobs').get_json()
+    assert status[-1] == job
+    from portfolioapi import views
+    with mock.patch.object(views, 'storeAllQuotes',
+                           side_effect=ValueError('bad')):
+        response = client.get('/update-quotes')
+    assert response.status_code == 500
+    assert response.get_json()['state'] == 'failed'
+    assert response.get_json()['error'] == 'ValueError: bad'
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+from portfolioapi import portfolio
+
+
+def test_match_options():
+    def make(action, name, count, amount1):
+        t = portfolio.Transaction(18000, action, name)
+        t.count = count
+        t.amount1 = amount1
+        return t
+    group = [make('b', 'AAPL200117C00100000', 1, 0),
+             make('s', 'AAPL', 100, 100.0),
+             make('b', 'AAPL200117P00100000', 1, 0),
+             make('b', 'AAPL', 100, 100.0),
+             make('b', 'MSFT', 100, 100.0),
+             make('s', 'AAPL200117P00100000', 1, 0)]
+    matched = portfolio.Portfolio.matchOptions(list(group))
+    # The stock sale takes the earlier of the bought call and the sold put,
+    # the stock purchase takes the bought put.
+    assert matched == [(group[1], group[0]), (group[3], group[2]), group[4],
+                       group[5]]
+    assert group[0].option[0] == 'AAPL' and group[0].is_option()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from portfolioapi import stockquotes
+from portfolioapi.quotematrix import QuoteMatrix
+
+
+def test_quote_matrix():
+    dates = [datetime.date(2020, 6, d) for d in [26, 29, 30]]
+    rows = [('2020-06-26', 'AAPL', 353.63), ('2020-06-26', 'SPY', 300),
+            ('2020-06-29', 'SPY', 304.46), ('2020-06-30', 'AAPL', 364.8),
+            ('2020-06-30', 'XYZ', 1.5)]
+    matrix = QuoteMatrix(dates, ['AAPL', 'SPY', 'VOO'], rows,
+                         initial={'VOO': 275.8})
+    assert matrix.prices.tolist() == [[353.63, 300, 275.8],
+                                      [353.63, 304.46, 275.8],
+                                      [364.8, 304.46, 275.8]]
+    assert matrix.asOf(datetime.date(2020, 6, 25)) == {'VOO': 275.8}
+    assert (matrix.asOf(datetime.date(2020, 6, 28), ['SPY', 'XYZ']) ==
+            {'SPY': 300})
+    assert type(matrix.asOf(datetime.date(2020, 6, 28))['SPY']) is int
+    matrix = QuoteMatrix(dates, ['AAPL', 'SPY'], rows[2:])
+    assert matrix.quotes(1, ['SPY', 'AAPL']) == [304.46, 0]
+    counts = matrix.counts([[('SPY', 10)], [], [('AAPL', 2), ('SPY', 1)]])
+    assert matrix.value(counts).tolist() == [0, 0, 364.8 * 2 + 304.46]
+    d, prices = matrix.slice(datetime.date(2020, 6, 27), dates[-1])
+    assert d == dates[1:] and prices.shape == (2, 2)
+
+
+def test_quote_matrix_value():
+    # Many positions so that the sum depends on the order of the additions
+    dates = [datetime.date(2020, 6, d) for d in [26, 29, 30]]
+    symbols = ['S{0:02d}'.format(i) for i in range(40)]
+    rows = [(d.isoformat(), s, round(10.01 + i * 13.37 + k * 0.29, 2))
+            for k, d in enumerate(dates) for i, s in enumerate(symbols)]
+    positions = [[(s, round(3.141 + i * 7.389 + k * 0.577, 3))
+                  for i, s in enumerate(symbols) if (i + k) % 3]
+                 for k in range(len(dates))]
+    matrix = QuoteMatrix(dates, symbols, rows)
+    value = matrix.value(matrix.counts(positions)).tolist()
+    # The sums of updateHistory without NumPy
+    assert value == [sum(n * q for (s, n), q in
+                         zip(p, matrix.quotes(k, [s for s, _ in p])))
+                     for k, p in enumerate(positions)]
+
+
+def test_quote_matrix_load(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    for d, rows in [('2020-06-24', 'AAPL,360.06\nVOO,280.4\n'),
+                    ('2020-06-26', 'AAPL,353.63\nSPY,300.05\n'),
+                    ('2020-06-29', 'AAPL,361.78\nSPY,304.46\n'),
+                    ('2020-07-01', 'SPY,310.52\nVOO,286\n')]:
+        with open(os.path.join(quote_dir, d + '.csv'), 'w') as f:
+            f.write(rows)
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    try:
+        stockquotes.storeAllQuotes()
+        symbols = ['AAPL', 'SPY', 'VOO', 'XYZ']
+        start = datetime.date(2020, 6, 25)
+        matrix = QuoteMatrix.load(symbols, start, datetime.date(2020, 7, 2))
+        for i in range(8):
+            d = start + datetime.timedelta(days=i)
+            assert matrix.asOf(d) == stockquotes.getQuotes(d, symbols)
+        dates, prices = matrix.slice(datetime.date(2020, 6, 27),
+                                     datetime.date(2020, 7, 1))
+        assert dates == [datetime.date(2020, 6, 29), datetime.date(2020, 7, 1)]
+        assert prices.tolist() == [[361.78, 304.46, 280.4, 0],
+                                   [361.78, 310.52, 286, 0]]
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import mock
+import os
+
+from portfolioapi import stockquotes
+
+
+def test_quotes_as_of(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    for d, rows in [('2020-06-26', 'AAPL,353.63\nSPY,300.05\nVOO,275.8\n'),
+                    ('2020-06-29', 'AAPL,361.78\nSPY,304.46\n'),
+                    ('2020-07-01', 'SPY,310.52\n')]:
+        with open(os.path.join(quote_dir, d + '.csv'), 'w') as f:
+            f.write(rows)
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    try:
+        stockquotes.storeAllQuotes()
+        symbols = ['AAPL', 'SPY', 'VOO', 'XYZ']
+        assert (stockquotes.getQuotes(datetime.date(2020, 6, 30), symbols) ==
+                {'AAPL': 361.78, 'SPY': 304.46, 'VOO': 275.8})
+        assert (stockquotes.getQuotes(datetime.date(2020, 7, 1), symbols,
+                                      same_day=True) == {'SPY': 310.52})
+        dates = [datetime.date(2020, 6, d) for d in [25, 28, 30]]
+        assert (stockquotes.getQuotesAsOf((d, symbols) for d in dates) ==
+                [stockquotes.getQuotes(d, symbols) for d in dates])
+        assert (stockquotes.getQuotesAsOf(
+            [(datetime.date(2020, 7, 1), ['AAPL', 'SPY']),
+             (datetime.date(2020, 6, 29), None)], same_day=True) ==
+                [{'SPY': 310.52}, {'AAPL': 361.78, 'SPY': 304.46}])
+        with stockquotes.getQuoteCursor() as c:
+            c.execute('INSERT INTO quotes(date,symbol,quote) '
+                      "VALUES('2020-07-01','VOO',281.1)")
+            # The uncommitted quote of the enclosing cursor is kept.
+            for _ in range(2):
+                assert (stockquotes.getQuotesAsOf(
+                    [(datetime.date(2020, 7, 1), ['VOO'])]) ==
+                        [{'VOO': 281.1}])
+            assert c.connection.in_transaction
+        assert (stockquotes.getQuotesAsOf(
+            [(datetime.date(2020, 7, 1), ['VOO'])]) == [{'VOO': 275.8}])
+        context = stockquotes.QuoteContext()
+        context.add(datetime.date(2020, 6, 30), ['AAPL'])
+        context.add(datetime.date(2020, 6, 30), ['VOO', 'XYZ'])
+        context.add(datetime.date(2020, 6, 25), [])
+        assert (context.get(datetime.date(2020, 6, 30)) ==
+                {'AAPL': 361.78, 'VOO': 275.8})
+        assert context.get(datetime.date(2020, 6, 30), ['VOO']) == {'VOO': 275.8}
+        assert context.get(datetime.date(2020, 6, 25)) == {}
+        with stockquotes.getQuoteCursor() as c:
+            c.execute('EXPLAIN QUERY PLAN SELECT quote FROM quotes '
+                      'WHERE symbol=? AND date<=? ORDER BY date DESC LIMIT 1',
+                      ['SPY', '2020-06-30'])
+            assert 'quotes_symbol' in ' '.join(r[-1] for r in c.fetchall())
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
+
+
+def test_store_changed_quotes(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+
+    def writeQuotes(d, rows):
+        with open(os.path.join(quote_dir, d + '.csv'), 'w') as f:
+            f.write(rows)
+
+    writeQuotes('2020-06-26', 'AAPL,353.63\nSPY,300.05\n')
+    writeQuotes('2020-06-29', 'AAPL,361.78\nSPY,304.46\n')
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    try:
+        assert stockquotes.storeAllQuotes() == datetime.date(2020, 6, 26)
+        version = stockquotes.getQuoteVersion()
+        assert stockquotes.storeAllQuotes() is None
+        assert stockquotes.getQuoteVersion() == version
+        # Rewriting a file with the same quotes doesn't change anything.
+        writeQuotes('2020-06-26', 'AAPL,353.63\nSPY,300.05\n')
+        writeQuotes('2020-06-30', 'SPY,310.52\n')
+        assert stockquotes.storeAllQuotes() == datetime.date(2020, 6, 30)
+        assert stockquotes.getQuoteVersion() == version + 1
+        writeQuotes('2020-06-29', 'AAPL,361.78\nSPY,304.5\n')
+        os.remove(os.path.join(quote_dir, '2020-06-30.csv'))
+        assert stockquotes.storeAllQuotes() == datetime.date(2020, 6, 29)
+        assert (stockquotes.getQuotes(datetime.date(2020, 7, 1)) ==
+                {'AAPL': 361.78, 'SPY': 304.5})
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
+
+
+def test_rebuild_quotes(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    with open(os.path.join(quote_dir, '2020-06-26.csv'), 'w') as f:
+        f.write('AAPL,353.63\nSPY,300.05\n')
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    try:
+        assert stockquotes.storeAllQuotes() == datetime.date(2020, 6, 26)
+        with stockquotes.getQuoteCursor() as c:
+            conn = c.connection
+        with open(os.path.join(quote_dir, '2020-06-29.csv'), 'w') as f:
+            f.write('SPY,304.46\n')
+        version = stockquotes.getQuoteVersion()
+        assert (stockquotes.storeAllQuotes(rebuild=True) ==
+                datetime.date(2020, 6, 26))
+        assert stockquotes.getQuoteVersion() == version + 1
+        with stockquotes.getQuoteCursor() as c:
+            assert c.connection is conn
+            assert c.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert (stockquotes.getQuotes(datetime.date(2020, 6, 29)) ==
+                {'SPY': 304.46})
+        assert stockquotes.storeAllQuotes() is None
+        # The temporary database is removed.
+        assert (sorted(os.listdir(os.path.join(tmp_path, 'cache'))) ==
+                ['quotes.db', 'quotes.db-shm', 'quotes.db-wal'])
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
+
+
+def test_day_quotes(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    with open(os.path.join(quote_dir, '2020-06-26.csv'), 'w') as f:
+        f.write('AAPL,353.63\nSPY,300.05\n')
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    try:
+        stockquotes.storeAllQuotes()
+        days = [(datetime.date(2020, 6, 26), ['AAPL', 'XYZ']),
+                (datetime.date(2020, 6, 29), ['SPY'])]
+        with stockquotes.getQuoteCursor() as c:
+            c.execute('INSERT INTO quotes(date,symbol,quote) '
+                      "VALUES('2020-06-29','SPY',304.46)")
+            # The uncommitted quote of the enclosing cursor is kept.
+            for _ in range(2):
+                assert (stockquotes.getDayQuotes(days) ==
+                        [('2020-06-26', 'AAPL', 353.63),
+                         ('2020-06-29', 'SPY', 304.46)])
+            assert c.connection.in_transaction
+        assert (stockquotes.getDayQuotes(days) ==
+                [('2020-06-26', 'AAPL', 353.63)])
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
+
+
+def test_retrieve_then_store_quotes(tmp_path):
+    quote_dir = os.path.join(tmp_path, 'quotes')
+    os.makedirs(quote_dir)
+    with open(os.path.join(quote_dir, '2020-06-26.csv'), 'w') as f:
+        f.write('AAPL,353.63\nSPY,300.05\n')
+    old_paths = (stockquotes.quote_dir, stockquotes.quote_db)
+    stockquotes.setQuotePaths(quote_dir,
+                              os.path.join(tmp_path, 'cache/quotes.db'))
+    today = datetime.date.today()
+    try:
+        assert stockquotes.storeAllQuotes() == datetime.date(2020, 6, 26)
+        with mock.patch.object(stockquotes, 'getHolidays', return_value=[]), \
+             mock.patch.object(stockquotes, 'retrieveJsonQuotes',
+                               return_value=[['SPY', 310.52]]):
+            assert stockquotes.retrieveQuotes(['SPY'])
+        # The retrieved quotes aren't loaded again.
+        assert stockquotes.storeAllQuotes() is None
+        assert stockquotes.getQuotes(today, ['SPY'], same_day=True) == {
+            'SPY': 310.52}
+        # Quotes of an untracked file are compared with the file.
+        with stockquotes.getQuoteCursor() as c:
+            c.execute('DELETE FROM quote_files WHERE date=?',
+                      [today.isoformat()])
+            c.connection.commit()
+        assert stockquotes.storeAllQuotes() is None
+        with open(os.path.join(quote_dir, today.isoformat() + '.csv'),
+                  'w') as f:
+            f.write('SPY,311\n')
+        assert stockquotes.storeAllQuotes() == today
+        assert stockquotes.getQuotes(today, ['SPY'], same_day=True) == {
+            'SPY': 311}
+    finally:
+        stockquotes.setQuotePaths(*old_paths)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+
+
+def test_response_cache(client):
+    # Imported here because "views" copies the paths set by "client".
+    from portfolioapi import views
+    url = '/get-spy?end=2020-06-29'
+    response = client.get(url)
+    etag = response.headers['ETag']
+    assert response.status_code == 200 and etag
+    response2 = client.get(url)
+    assert response2.headers['ETag'] == etag
+    assert response2.data == response.data
+    assert client.get(url, headers={'If-None-Match': etag}).status_code == 304
+    assert client.get('/get-spy?end=2020-06-30').headers['ETag'] != etag
+    # Errors aren't cached.
+    size = len(views.response_cache)
+    response = client.get('/get-taxes?account=missing&year=x')
+    assert b'"error"' in response.data
+    assert len(views.response_cache) == size
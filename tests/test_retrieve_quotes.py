@@ -4,6 +4,7 @@ from .conftest import MockHTTPResponse
 import json
 import mock
 import os
+import urllib.error
 
 
 def test_get_report(client):
@@ -12,3 +13,28 @@ def test_get_report(client):
                     return_value=MockHTTPResponse(path=path)) as mock_urlopen:
         response = client.get('/retrieve-quotes?force=true')
         assert mock_urlopen.call_count == 1
+
+
+def test_retrieve_json_quotes():
+    from portfolioapi import stockquotes
+    requested = []
+
+    def urlopen(req, data, timeout):
+        symbols = req.full_url.split('symbols=')[1].split('&')[0].split(',')
+        if symbols[0] == 'S1' and symbols not in requested:
+            requested.append(symbols)
+            raise urllib.error.URLError('timeout')
+        requested.append(symbols)
+        result = [{'symbol': s, 'regularMarketPrice': float(s[1:])}
+                  for s in symbols]
+        return MockHTTPResponse(data=json.dumps(
+            {'quoteResponse': {'result': result}}).encode())
+
+    symbols = ['S{0}'.format(i) for i in range(1, 62)]
+    with mock.patch('urllib.request.urlopen', side_effect=urlopen), \
+         mock.patch.object(stockquotes, 'json_retry_delay', 0):
+        quotes = stockquotes.retrieveJsonQuotes(symbols)
+    assert quotes == [[s, float(s[1:])] for s in symbols]
+    # Four batches of 20, 20, 19, and 2 symbols and one retry
+    assert len(requested) == 5
+    assert sorted(len(s) for s in requested) == [2, 19, 20, 20, 20]
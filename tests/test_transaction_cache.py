@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+import pytest
+
+from portfolioapi import columnar, lineindex, portfolio
+
+
+def test_transaction_cache(tmp_path):
+    path = os.path.join(tmp_path, 'account')
+    with open(path, 'w') as f:
+        f.write('1998-12-21|d|Deposit|278000\n'
+                '1999-04-19|b|QQQ|100|99.75|29.95\n'
+                '2000-03-20|x|QQQ|1\n')
+    Transaction = portfolio.Transaction
+    trans = Transaction.readTransactions(path)
+    assert [t.type for t in trans] == ['d', 'b', 'x']
+    # Unchanged files are served from the cache and sliced by date.
+    trans2 = Transaction.readTransactions(path,
+                                          Transaction.parseDate('1999-04-19'))
+    assert trans2 == trans[:2]
+    with open(path, 'a') as f:
+        f.write('2004-12-01|c|QQQ|1|QQQQ\n')
+    trans = Transaction.readTransactions(path)
+    assert [t.type for t in trans] == ['d', 'b', 'x', 'c']
+
+
+def test_compiled_transactions(tmp_path):
+    path = os.path.join(tmp_path, 'account')
+    with open(path, 'w') as f:
+        f.write('1998-12-21|d|Deposit|278000\n'
+                '1999-04-19|b|QQQ|100|99.75|29.95  # comment\n'
+                '1999-04-20|s|QQQ|50\n'
+                '2010-01-04|c|MVL|0.7452|DIS|30|0.5552193394\n')
+    fingerprint = (1, 2, 3)
+    trans = portfolio.TransactionFile.parse(path, fingerprint).transactions
+    compiled = os.path.join(tmp_path, 'compiled', 'account')
+    assert columnar.write(compiled, fingerprint, trans)
+    assert columnar.load(compiled, (1, 2, 4), portfolio.Transaction) is None
+    trans2 = columnar.load(compiled, fingerprint, portfolio.Transaction)
+    assert len(trans2) == len(trans)
+    for t, t2 in zip(trans, trans2):
+        for k in portfolio.Transaction.__slots__:
+            v, v2 = getattr(t, k), getattr(t2, k)
+            assert v == v2 and type(v) == type(v2)
+    assert trans2[1] is trans2[1]
+    assert list(trans2.ends) == [t.date for t in trans]
+
+
+def test_transaction_timeline(tmp_path):
+    path = os.path.join(tmp_path, 'account')
+    with open(path, 'w') as f:
+        f.write('1998-12-21|d|Deposit|278000\n'
+                '1999-04-19|b|QQQ|100|99.75|29.95\n'
+                '1999-04-19|d|Deposit|1000\n'
+                '2000-03-20|x|QQQ|1\n')
+    Transaction = portfolio.Transaction
+    date = Transaction.parseDate
+    trans = Transaction.readTimeline(path)
+    assert trans.bad is None and len(trans) == 4
+    assert [t.type for t in trans.range(date('1998-12-21'),
+                                        date('1999-04-19'))] == ['b', 'd']
+    assert [t.type for t in trans.day(date('1999-04-19'))] == ['b', 'd']
+    assert [t.type for t in trans.range(date('1999-04-19'))] == ['x']
+    assert [(k, len(g)) for k, g in trans.years()] == [(1998, 1), (1999, 2),
+                                                       (2000, 1)]
+    assert len(Transaction.readTimeline(path, date('1999-04-18'))) == 1
+    with open(path, 'a') as f:
+        f.write('1999-05-03|s|QQQ|50|120|10\n')
+    trans = Transaction.readTimeline(path)
+    assert trans.bad is trans[4]
+    assert Transaction.checkTransactions(list(trans)) is trans.bad
+    # Out of order, the file order is kept.
+    assert [t.type for t in trans.range(date('1999-01-01'),
+                                        date('2000-12-31'))] == ['b', 'd', 'x',
+                                                                 's']
+
+
+def test_line_index(tmp_path):
+    path = os.path.join(tmp_path, 'account')
+    with open(path, 'w') as f:
+        f.write('# Brokerage\n'
+                '1998-12-21|d|Deposit|278000\n'
+                '1999-04-19|b|QQQ|100|99.75|29.95\n'
+                '1999-04-19|d|Déposit|1000\n'
+                '2000-03-20|x|QQQ|1\n')
+    Transaction = portfolio.Transaction
+    date = Transaction.parseDate
+    old_cache_dir = portfolio.cache_dir
+    portfolio.cache_dir = os.path.join(tmp_path, 'cache')
+    try:
+        portfolio.transaction_cache.clear()
+        trans = Transaction.readWindow(path, date('1998-12-21'),
+                                       date('1999-12-31'))
+        assert [t.name for t in trans] == ['QQQ', 'Déposit']
+        # The window is read without loading the file into the cache.
+        st = os.stat(path)
+        fingerprint = (st.st_mtime_ns, st.st_size, st.st_ino)
+        assert portfolio.transaction_cache.peek(path, fingerprint) is None
+        index = lineindex.load(os.path.join(tmp_path, 'cache', 'index',
+                                            'account'), fingerprint)
+        assert list(index.dates) == [t.date for t in
+                                     Transaction.readTransactions(path)]
+        assert (list(Transaction.readWindow(path, end=date('1999-04-18'))) ==
+                Transaction.readTransactions(path)[:1])
+        portfolio.transaction_cache.clear()
+        # The index is rebuilt after a change.  Out of order, the window is
+        # filtered.
+        with open(path, 'a') as f:
+            f.write('1999-05-03|s|QQQ|50|120|10\n')
+        assert [t.type for t in
+                Transaction.readWindow(path, date('1999-04-30'),
+                                       date('2000-12-31'))] == ['x', 's']
+        # A parse error is only raised when reading past the transactions.
+        with open(path, 'a') as f:
+            f.write('2001-01-02|b|QQQ|x\n')
+        assert len(Transaction.readWindow(path, end=date('1999-04-19'))) == 3
+        with pytest.raises(ValueError):
+            Transaction.readWindow(path)
+        with pytest.raises(ValueError):
+            Transaction.readTransactions(path)
+    finally:
+        portfolio.cache_dir = old_cache_dir
+        portfolio.transaction_cache.clear()
@@ -3,6 +3,7 @@
 import io
 import json
 import os
+import pickle
 
 from portfolioapi import portfolio
 
@@ -39,3 +40,23 @@ def test_wash_sale(client):
                            'wash_sale.json')) as f:
         expected = json.load(f)
     assert yearend['completed_lots'] == expected
+
+
+def test_wash_window():
+    lots = [portfolio.Lot(sym, 100, 10, 0, 0, date)
+            for sym, date in [('A', 1), ('B', 2), ('A', 3), ('B', 40)]]
+    window = portfolio.WashWindow('purchase_date', lots)
+    assert window.items('A') == [lots[0], lots[2]]
+    lot = portfolio.Lot('A', 50, 10, 0, 0, 1)
+    window.insertAfter(lots[0], lot)
+    assert window.items('A') == [lots[0], lot, lots[2]]
+    window.remove(lots[0])
+    assert list(window) == [lot, lots[1], lots[2], lots[3]]
+    # Like the list it replaces, only a prefix is removed.
+    window.trim(2)
+    assert list(window) == [lots[2], lots[3]]
+    lots[2].symbol = 'B'
+    window.reindex()
+    assert window.items('A') == [] and window.items('B') == lots[2:]
+    window = pickle.loads(pickle.dumps(window))
+    assert [lt.purchase_date for lt in window.items('B')] == [3, 40]